@@ -0,0 +1,38 @@
+"""
+会话标题回填脚本
+通过 Batch API 为仍使用默认标题的会话批量生成标题（非实时任务，成本更低）
+"""
+import asyncio
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from chat_service import ChatService
+from config import get_settings
+from database import AsyncSessionLocal
+from db_operations import DatabaseManager
+
+
+async def main():
+    """主函数：回填默认标题会话的标题"""
+    service = ChatService(get_settings())
+    await service.initialize()
+    try:
+        async with AsyncSessionLocal() as db:
+            db_manager = DatabaseManager(db)
+            rows = await db_manager.get_untitled_sessions()
+            if not rows:
+                print("没有需要回填标题的会话")
+                return
+            
+            print(f"开始为 {len(rows)} 个会话生成标题（批量任务可能需要较长时间）...")
+            titles = await service.batch_generate_titles([row.first_message for row in rows])
+            await db_manager.set_session_titles({row.id: title for row, title in zip(rows, titles)})
+            print("标题回填完成！")
+    finally:
+        await service.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -4,24 +4,103 @@ AutoGen 聊天服务
 支持多会话管理，每个会话使用独立的 agent
 """
 import asyncio
-from typing import AsyncGenerator, Optional, Any, Dict, List, TYPE_CHECKING
+import hashlib
+import json
+from typing import AsyncGenerator, Optional, Any, Dict, List, Sequence, Tuple
 from collections import OrderedDict
+from dataclasses import asdict
 
+from contextlib import asynccontextmanager
+
+import httpx
+from cachetools import LRUCache
 from autogen_agentchat.agents import AssistantAgent
 from autogen_agentchat.base import TaskResult, TerminationCondition
 from autogen_agentchat.conditions import TextMentionTermination, MaxMessageTermination, TokenUsageTermination, \
     SourceMatchTermination
 from autogen_agentchat.messages import TextMessage, BaseAgentEvent, BaseChatMessage, ModelClientStreamingChunkEvent
 from autogen_agentchat.teams import RoundRobinGroupChat
+from autogen_core import CancellationToken
+from autogen_core.model_context import BufferedChatCompletionContext
+from autogen_core.models import AssistantMessage, LLMMessage, SystemMessage, UserMessage
 from autogen_ext.models.openai import OpenAIChatCompletionClient
+from openai import AsyncOpenAI
 
 from termination_condition import SourcePrefixTermination
 from config import Settings
 from models import ModelInfo
+from semantic_cache import SemanticCache, paraphrases
 from logger import logger
 
-if TYPE_CHECKING:
-    from database import Message
+# 历史消息：(角色, 内容)，角色为 'user' 或 'assistant'
+HistoryMessage = Tuple[str, str]
+
+
+# 模型信息是静态配置，只在模块加载时构建一次
+_MODEL_INFO_DICT: Dict[str, Any] = asdict(ModelInfo())
+
+_TITLE_SYSTEM_MESSAGE = "为对话生成10-20字的简短标题，只返回标题。"
+
+_TITLE_PROMPT_TEMPLATE = (
+    "请为以下用户消息生成一个简短的对话标题。\n\n"
+    "要求：\n"
+    "1. 长度：10-20个汉字\n"
+    "2. 准确概括对话主题\n"
+    "3. 只返回标题文本，不要其他内容\n"
+    "4. 不要使用引号或标点符号\n\n"
+    "用户消息：\n"
+    "{msg}\n\n"
+    "标题："
+)
+
+# 清理标题：移除引号，换行替换为空格
+_TITLE_STRIP_TABLE = str.maketrans({'"': '', "'": '', '\n': ' '})
+
+# 流式输出队列：生产者（读取模型流）与消费者（HTTP 发送）解耦，队列满时对生产者施加背压
+_STREAM_QUEUE_SIZE = 64
+_STREAM_END = object()
+
+# 需要转发给前端的流式内容块来源（agent 名称前缀）
+_STREAM_SOURCE_PREFIXES = ("assistant", "quality_agent")
+
+# 摘要的输出长度上限（覆盖标题客户端的 max_tokens）
+_SUMMARY_MAX_TOKENS = 512
+
+_SUMMARY_SYSTEM_MESSAGE = "你是一个对话摘要助手，负责将对话历史压缩为简洁准确的摘要。"
+
+_SUMMARY_PROMPT_TEMPLATE = (
+    "请将以下对话内容压缩为一份摘要。\n\n"
+    "要求：\n"
+    "1. 保留用户的关键问题、偏好和已得出的结论\n"
+    "2. 不超过300字\n"
+    "3. 只返回摘要文本，不要其他内容\n\n"
+    "对话内容：\n"
+    "{history}\n\n"
+    "摘要："
+)
+
+
+class _SummaryContext(BufferedChatCompletionContext):
+    """只保留最近 N 条消息的上下文，历史摘要（如有）固定在最前面，不会被挤出缓冲区"""
+    
+    def __init__(self, buffer_size: int, initial_messages: Optional[List[LLMMessage]] = None):
+        super().__init__(buffer_size=buffer_size, initial_messages=initial_messages)
+        self.summary: Optional[UserMessage] = None
+    
+    async def get_messages(self) -> List[LLMMessage]:
+        messages = await super().get_messages()
+        if self.summary is None:
+            return messages
+        return [self.summary, *messages]
+
+
+class _AgentCache(LRUCache):
+    """会话 agent 的 LRU 缓存，淘汰最久未使用的 agent 时记录日志"""
+    
+    def popitem(self) -> Tuple[str, RoundRobinGroupChat]:
+        session_id, agent = super().popitem()
+        logger.info("删除最旧的 agent (会话: {:.8}..., 当前 agent 数: {})", session_id, len(self))
+        return session_id, agent
 
 
 class ChatService:
@@ -33,20 +112,44 @@ class ChatService:
     - 自动清理不活跃的 agent
     """
     
-    def __init__(self, settings: Settings, max_agents: int = 50):
+    def __init__(
+        self,
+        settings: Settings,
+        max_agents: int = 50,
+        semantic_cache: Optional[SemanticCache] = None
+    ):
         """初始化聊天服务
         
         Args:
             settings: 配置对象
             max_agents: 最大 agent 数量（LRU 缓存大小）
+            semantic_cache: 语义缓存，默认根据配置创建；关闭缓存时为 None
         """
         self.settings: Settings = settings
         self.model_client: Optional[OpenAIChatCompletionClient] = None
+        self.title_model_client: Optional[OpenAIChatCompletionClient] = None
+        self._http_client: Optional[httpx.AsyncClient] = None
         self.initialized: bool = False
         
-        # 多会话支持：session_id -> agent 映射
-        self.agents: OrderedDict[str, AssistantAgent] = OrderedDict()
+        # 多会话支持：session_id -> agent 映射（LRU，读取即更新为最近使用）
         self.max_agents: int = max_agents  # 最大 agent 数量
+        self.agents: _AgentCache = _AgentCache(maxsize=max_agents)
+        # 后台生成中的历史摘要：session_id -> (任务, 被折叠的消息数, agent, 上下文)
+        self._pending_summaries: LRUCache = LRUCache(maxsize=max_agents)
+        
+        # 语义缓存：相似的消息直接复用已有回复
+        if semantic_cache is None and settings.semantic_cache_enabled:
+            semantic_cache = SemanticCache(max_entries=settings.semantic_cache_size)
+        self.semantic_cache: Optional[SemanticCache] = semantic_cache
+        self._cache_namespace: str = SemanticCache.namespace_for(settings.system_message)
+        
+        # 标题缓存：规范化后的首条消息哈希 -> 标题
+        self._title_cache: OrderedDict[bytes, str] = OrderedDict()
+        
+        self._warmup_task: Optional[asyncio.Task] = None
+        
+        # 无状态聊天（chat / stream_chat）使用的预建 agent 池，在 initialize() 中填充
+        self._temp_agents: asyncio.Queue = asyncio.Queue()
         
     async def initialize(self) -> None:
         """初始化 OpenAI 模型客户端（所有 agent 共享）"""
@@ -55,36 +158,113 @@ class ChatService:
             return
         
         try:
-            # 创建模型信息
-            model_info = ModelInfo()
-            
             # 创建模型客户端（所有 agent 共享同一个客户端）
             model_kwargs: Dict[str, Any] = {
                 "model": self.settings.model_name,
                 "api_key": self.settings.openai_api_key,
-                "model_info": model_info.model_dump(),
+                "model_info": _MODEL_INFO_DICT,
             }
             
             if self.settings.openai_api_base:
                 model_kwargs["base_url"] = self.settings.openai_api_base
             
-            logger.info(f"正在创建模型客户端: {self.settings.model_name}")
+            # 使用 aiohttp 传输，提升并发请求下的吞吐
+            self._http_client = self._create_http_client()
+            model_kwargs["http_client"] = self._http_client
+            
+            logger.info("正在创建模型客户端: {}", self.settings.model_name)
             self.model_client = OpenAIChatCompletionClient(**model_kwargs)
             
+            # 标题生成使用独立的客户端（共享 HTTP 连接池），限制输出长度
+            title_kwargs = dict(model_kwargs, max_tokens=self.settings.title_max_tokens)
+            if self.settings.title_model_name:
+                title_kwargs["model"] = self.settings.title_model_name
+            self.title_model_client = OpenAIChatCompletionClient(**title_kwargs)
+            
+            for _ in range(max(1, self.settings.temp_agent_pool_size)):
+                self._temp_agents.put_nowait(self._new_temp_agent())
+            
             self.initialized = True
-            logger.info(f"✓ 聊天服务初始化完成 (模型: {self.settings.model_name})")
+            logger.info("✓ 聊天服务初始化完成 (模型: {})", self.settings.model_name)
+            
+            # 后台预热连接池，把 DNS/TLS 握手从首个用户请求中移出
+            self._warmup_task = asyncio.create_task(self._warmup())
             
         except Exception as e:
-            logger.error(f"初始化失败: {str(e)}", exc_info=True)
+            logger.error("初始化失败: {}", e, exc_info=True)
             raise
     
-    def _get_or_create_agent(self, session_id: str) -> AssistantAgent:
+    async def _warmup(self) -> None:
+        """预热 HTTP 连接：请求一次 /models 建立并保持到模型服务的连接
+        
+        失败不影响服务，首个请求时会照常建立连接。
+        """
+        base_url = (self.settings.openai_api_base or "https://api.openai.com/v1").rstrip("/")
+        try:
+            await self._http_client.get(
+                f"{base_url}/models",
+                headers={"Authorization": f"Bearer {self.settings.openai_api_key}"},
+                timeout=10.0
+            )
+            logger.debug("模型服务连接预热完成")
+        except Exception as e:
+            logger.debug("模型服务连接预热失败: {}", e)
+    
+    def _new_temp_agent(self) -> AssistantAgent:
+        """创建一个无状态聊天使用的临时 agent"""
+        return AssistantAgent(
+            name="assistant_temp",
+            model_client=self.model_client,
+            system_message=self.settings.system_message,
+            model_client_stream=True
+        )
+    
+    @asynccontextmanager
+    async def _acquire_temp_agent(self) -> AsyncGenerator[AssistantAgent, None]:
+        """从池中取出一个无状态 agent，用完后重置上下文并归还
+        
+        池为空时直接新建一个 agent，不限制并发；归还时池中最多保留
+        temp_agent_pool_size 个，多余的丢弃。
+        """
+        try:
+            agent = self._temp_agents.get_nowait()
+        except asyncio.QueueEmpty:
+            agent = self._new_temp_agent()
+        try:
+            yield agent
+        finally:
+            await agent.on_reset(CancellationToken())
+            if self._temp_agents.qsize() < self.settings.temp_agent_pool_size:
+                self._temp_agents.put_nowait(agent)
+    
+    @staticmethod
+    def _create_http_client() -> httpx.AsyncClient:
+        """创建 OpenAI SDK 使用的 HTTP 客户端
+        
+        优先使用 aiohttp 传输（需要安装 openai[aiohttp]），
+        不可用时回退到默认的 httpx 传输。
+        """
+        try:
+            from openai import DefaultAioHttpClient
+            return DefaultAioHttpClient()
+        except (ImportError, RuntimeError):
+            from openai import DefaultAsyncHttpxClient
+            logger.warning("aiohttp 传输不可用，使用默认 httpx 传输 (可安装 openai[aiohttp])")
+            return DefaultAsyncHttpxClient()
+    
+    def _get_or_create_agent(
+        self,
+        session_id: str,
+        history: Optional[Sequence[HistoryMessage]] = None
+    ) -> RoundRobinGroupChat:
         """获取或创建会话的 agent
         
         每个会话有独立的 agent 实例，使用 LRU 缓存策略。
+        agent 会保留自身的对话状态；仅在首次创建时用数据库中的历史消息初始化上下文。
         
         Args:
             session_id: 会话 ID
+            history: 历史消息列表（已按时间排序），仅在创建 agent 时使用
             
         Returns:
             该会话的 agent 实例
@@ -92,25 +272,52 @@ class ChatService:
         if not self.initialized or not self.model_client:
             raise RuntimeError("聊天服务未初始化")
         
-        # 如果 agent 已存在，移到最后（LRU）
-        if session_id in self.agents:
-            self.agents.move_to_end(session_id)
-            logger.debug(f"使用已存在的 agent (会话: {session_id[:8]}...)")
-            return self.agents[session_id]
+        # 如果 agent 已存在，get 会将其标记为最近使用（LRU）
+        agent = self.agents.get(session_id)
+        if agent is not None:
+            logger.debug("使用已存在的 agent (会话: {:.8}...)", session_id)
+            return agent
         
         # 创建新的 agent
-        logger.info(f"为会话创建新 agent (会话: {session_id[:8]}...)")
+        logger.info("为会话创建新 agent (会话: {:.8}...)", session_id)
+        assistant_name = f"assistant_{session_id[:8]}"
+        quality_name = f"quality_agent_{session_id[:8]}"
+        
+        # 用历史消息初始化两个参与者的上下文（一次性构建消息列表）
+        history = history or ()
+        assistant_messages: List[LLMMessage] = [
+            UserMessage(content=content, source="user") if role == "user"
+            else AssistantMessage(content=content, source=assistant_name)
+            for role, content in history
+        ]
+        # 质检 agent 将助手的回复视为待评估的输入
+        quality_messages: List[LLMMessage] = [
+            UserMessage(content=content, source="user" if role == "user" else assistant_name)
+            for role, content in history
+        ]
+        
+        assistant_context = _SummaryContext(
+            buffer_size=self.settings.agent_context_size,
+            initial_messages=assistant_messages
+        )
+        quality_context = _SummaryContext(
+            buffer_size=self.settings.agent_context_size,
+            initial_messages=quality_messages
+        )
+        
         assistant_agent = AssistantAgent(
-            name=f"assistant_{session_id[:8]}",
+            name=assistant_name,
             model_client=self.model_client,
             system_message=self.settings.system_message,
+            model_context=assistant_context,
             model_client_stream=True
         )
 
         quality_agent = AssistantAgent(
-            name=f"quality_agent_{session_id[:8]}",
+            name=quality_name,
             model_client=self.model_client,
             system_message=self.settings.quality_message,
+            model_context=quality_context,
             model_client_stream=True
         )
 
@@ -118,15 +325,11 @@ class ChatService:
 
         agent = RoundRobinGroupChat(participants=[assistant_agent, quality_agent], termination_condition=termination_condition)
         
+        # LRU 缓存：超过最大数量时自动删除最久未使用的 agent
         self.agents[session_id] = agent
+        self._schedule_summary(session_id, agent, (assistant_context, quality_context), history)
         
-        # LRU 缓存：如果超过最大数量，删除最旧的
-        if len(self.agents) > self.max_agents:
-            oldest_session_id = next(iter(self.agents))
-            removed_agent = self.agents.pop(oldest_session_id)
-            logger.info(f"删除最旧的 agent (会话: {oldest_session_id[:8]}..., 当前 agent 数: {len(self.agents)})")
-        
-        logger.debug(f"当前活跃 agent 数量: {len(self.agents)}")
+        logger.debug("当前活跃 agent 数量: {}", len(self.agents))
         return agent
     
     def remove_agent(self, session_id: str) -> None:
@@ -135,92 +338,198 @@ class ChatService:
         Args:
             session_id: 会话 ID
         """
-        if session_id in self.agents:
-            self.agents.pop(session_id)
-            logger.info(f"删除 agent (会话: {session_id[:8]}..., 剩余 agent: {len(self.agents)})")
+        pending = self._pending_summaries.pop(session_id, None)
+        if pending is not None:
+            pending[0].cancel()
+        if self.agents.pop(session_id, None) is not None:
+            logger.info("删除 agent (会话: {:.8}..., 剩余 agent: {})", session_id, len(self.agents))
     
     def clear_all_agents(self) -> None:
         """清除所有 agent（用于重置）"""
         count = len(self.agents)
-        self.agents.clear()
-        logger.info(f"清除了 {count} 个 agent")
+        # 直接替换为新缓存，避免 clear() 逐个 popitem 触发淘汰日志
+        self.agents = _AgentCache(maxsize=self.max_agents)
+        for task, *_ in self._pending_summaries.values():
+            task.cancel()
+        self._pending_summaries.clear()
+        logger.info("清除了 {} 个 agent", count)
     
     def _extract_response(self, response: Any) -> str:
         """提取响应内容"""
-        if hasattr(response, 'messages') and response.messages:
+        try:
             last_message = response.messages[-1]
-            if hasattr(last_message, 'content'):
-                return str(last_message.content)
+        except (AttributeError, IndexError, TypeError):
+            return str(response)
+        
+        try:
+            return str(last_message.content)
+        except AttributeError:
             return str(last_message)
+    
+    def _schedule_summary(
+        self,
+        session_id: str,
+        agent: RoundRobinGroupChat,
+        contexts: Tuple[_SummaryContext, ...],
+        history: Sequence[HistoryMessage]
+    ) -> None:
+        """历史较长时在后台将较早的消息压缩为摘要，不阻塞当前轮对话
+        
+        摘要完成后在该会话的下一轮对话开始前替换上下文中的对应消息。
+        
+        Args:
+            session_id: 会话 ID
+            agent: 会话的 agent
+            contexts: 需要替换的 agent 上下文（初始消息与 history 一一对应）
+            history: 创建 agent 时使用的历史消息
+        """
+        if len(history) <= self.settings.history_summary_trigger:
+            return
+        
+        old = history[:-self.settings.history_max_turns]
+        if not old:
+            return
+        
+        task = asyncio.create_task(self._summarize(old))
+        self._pending_summaries[session_id] = (task, len(old), agent, contexts)
+    
+    async def _apply_pending_summary(self, session_id: str, agent: RoundRobinGroupChat) -> None:
+        """若会话的摘要已经生成，用摘要替换上下文中较早的消息
+        
+        摘要固定在上下文最前面，之后的多轮对话中不会被挤出缓冲区。
+        
+        摘要尚未完成时直接返回，留到下一轮再尝试。
+        
+        Args:
+            session_id: 会话 ID
+            agent: 即将运行的会话 agent
+        """
+        pending = self._pending_summaries.get(session_id)
+        if pending is None:
+            return
+        
+        task, folded, owner, contexts = pending
+        if owner is not agent:
+            # agent 已被淘汰重建，摘要对应的上下文已不存在
+            task.cancel()
+            self._pending_summaries.pop(session_id, None)
+            return
+        if not task.done():
+            return
         
-        return str(response)
+        self._pending_summaries.pop(session_id, None)
+        try:
+            summary = task.result()
+        except Exception as e:
+            logger.warning("历史摘要失败，继续使用完整历史: {}", e)
+            return
+        if not summary:
+            return
+        
+        summary_message = UserMessage(content=f"此前对话的摘要：{summary}", source="summary")
+        for context in contexts:
+            # 移除已折叠进摘要的消息
+            state = await context.save_state()
+            state["messages"] = state["messages"][folded:]
+            await context.load_state(state)
+            context.summary = summary_message
+        logger.debug("已将 {} 条历史消息折叠为摘要 (会话: {:.8}...)", folded, session_id)
+    
+    async def _summarize(self, messages: Sequence[HistoryMessage]) -> str:
+        """将历史消息压缩为摘要（使用标题生成的轻量模型客户端）"""
+        history = "\n\n".join(f"{role}: {content}" for role, content in messages)
+        result = await self.title_model_client.create(
+            [
+                SystemMessage(content=_SUMMARY_SYSTEM_MESSAGE),
+                UserMessage(content=_SUMMARY_PROMPT_TEMPLATE.format(history=history), source="user"),
+            ],
+            # 标题客户端默认的输出长度上限只够生成标题
+            extra_create_args={"max_tokens": _SUMMARY_MAX_TOKENS},
+        )
+        return str(result.content).strip()
     
     async def chat(self, message: str) -> str:
-        """非流式聊天（兼容旧接口，使用临时 agent）"""
+        """非流式聊天（兼容旧接口，使用池中的临时 agent）"""
         if not self.initialized or not self.model_client:
             raise RuntimeError("聊天服务未初始化")
         
         try:
-            logger.debug(f"处理聊天请求: {message}")
+            logger.debug("处理聊天请求: {}", message)
             
-            # 使用临时 agent
-            temp_agent = AssistantAgent(
-                name="assistant_temp",
-                model_client=self.model_client,
-                system_message=self.settings.system_message,
-            )
+            if self.semantic_cache:
+                cached = self.semantic_cache.lookup(self._cache_namespace, message)
+                if cached is not None:
+                    return cached
             
-            # 运行代理
-            response = await temp_agent.run(task=message)
+            # 使用池中的临时 agent
+            async with self._acquire_temp_agent() as temp_agent:
+                response = await temp_agent.run(task=message)
             
             # 提取响应内容
             result = self._extract_response(response)
-            logger.debug(f"聊天响应: {result[:100]}...")
+            logger.debug("聊天响应: {:.100}...", result)
+            
+            if self.semantic_cache:
+                self.semantic_cache.store(self._cache_namespace, message, result)
+                # 消息的等价改写作为别名指向同一回复（本地模板生成，不调用模型）
+                if self.settings.semantic_cache_prefetch_k > 0:
+                    self.semantic_cache.add_aliases(
+                        self._cache_namespace,
+                        message,
+                        paraphrases(message, self.settings.semantic_cache_prefetch_k)
+                    )
             
             return result
             
         except Exception as e:
-            logger.error(f"聊天错误: {str(e)}", exc_info=True)
+            logger.error("聊天错误: {}", e, exc_info=True)
             raise
     
     async def stream_chat(self, message: str) -> AsyncGenerator[str, None]:
-        """流式聊天（兼容旧接口，使用临时 agent）"""
+        """流式聊天（兼容旧接口，使用池中的临时 agent）"""
         if not self.initialized or not self.model_client:
             raise RuntimeError("聊天服务未初始化")
         
         try:
-            logger.debug(f"处理流式聊天请求: {message}")
-            
-            # 使用临时 agent
-            temp_agent = AssistantAgent(
-                name="assistant",
-                model_client=self.model_client,
-                system_message=self.settings.system_message,
-                model_client_stream=True
-            )
-            
-            # 使用 AutoGen 的流式 API
-            response = temp_agent.run_stream(task=message)
-
-            async for chunk in response:
-                if isinstance(chunk, ModelClientStreamingChunkEvent) and (chunk.source.startswith("assistant") or chunk.source.startswith("quality_agent")):
-                    yield chunk.content
+            logger.debug("处理流式聊天请求: {}", message)
+            
+            if self.semantic_cache:
+                cached = self.semantic_cache.lookup(self._cache_namespace, message)
+                if cached is not None:
+                    # 命中缓存时整段输出，不人为放慢
+                    yield cached
+                    return
+            
+            # 绑定为局部变量，减少逐 token 循环中的全局查找
+            _ChunkEvent = ModelClientStreamingChunkEvent
+            _prefixes = _STREAM_SOURCE_PREFIXES
+            parts: List[str] = []
+            
+            # 使用池中的临时 agent 及 AutoGen 的流式 API
+            async with self._acquire_temp_agent() as temp_agent:
+                async for chunk in temp_agent.run_stream(task=message):
+                    if type(chunk) is _ChunkEvent and chunk.source.startswith(_prefixes):
+                        parts.append(chunk.content)
+                        yield chunk.content
+            
+            if self.semantic_cache and parts:
+                self.semantic_cache.store(self._cache_namespace, message, "".join(parts))
                 
         except Exception as e:
             error_msg = f"流式聊天错误: {str(e)}"
-            logger.error(error_msg, exc_info=True)
+            logger.error("{}", error_msg, exc_info=True)
             yield f"抱歉，发生了错误: {str(e)}"
     
     async def chat_with_context(
         self, 
         session_id: str,
         message: str, 
-        history: List["Message"]
+        history: Sequence[HistoryMessage]
     ) -> str:
         """带上下文的聊天（多会话版本）
         
-        将历史消息作为上下文传递给 AI，实现多轮对话。
-        每个会话使用独立的 agent。
+        每个会话使用独立的 agent，agent 自身保留多轮对话状态；
+        历史消息只在首次创建 agent 时用于初始化上下文。
         
         Args:
             session_id: 会话 ID
@@ -235,45 +544,33 @@ class ChatService:
         
         try:
             # 获取或创建该会话的 agent
-            agent = self._get_or_create_agent(session_id)
+            agent = self._get_or_create_agent(session_id, history)
+            await self._apply_pending_summary(session_id, agent)
             
-            logger.debug(f"处理带上下文的聊天请求 (会话: {session_id[:8]}...): {message[:50]}...")
-            logger.debug(f"上下文包含 {len(history)} 条历史消息")
+            logger.debug("处理带上下文的聊天请求 (会话: {:.8}...): {:.50}...", session_id, message)
+            logger.debug("上下文包含 {} 条历史消息", len(history))
             
-            # 构建完整的对话上下文
-            # 如果有历史消息，将其作为系统上下文
-            if history:
-                context_messages = []
-                for msg in history:
-                    context_messages.append(f"{msg.role}: {msg.content}")
-                
-                # 构建包含历史的完整提示
-                full_prompt = f"以下是之前的对话历史：\n\n" + "\n\n".join(context_messages)
-                full_prompt += f"\n\n现在用户说：{message}\n\n请基于上下文回复用户。"
-                
-                response = await agent.run(task=full_prompt)
-            else:
-                # 没有历史记录，直接回答
-                response = await agent.run(task=message)
+            # agent 已持有历史，只需传入新消息
+            response = await agent.run(task=TextMessage(source="user", content=message))
             
             result = self._extract_response(response)
-            logger.debug(f"聊天响应: {result[:100]}...")
+            logger.debug("聊天响应: {:.100}...", result)
             
             return result
             
         except Exception as e:
-            logger.error(f"带上下文聊天错误: {str(e)}", exc_info=True)
+            logger.error("带上下文聊天错误: {}", e, exc_info=True)
             raise
     
     async def stream_chat_with_context(
         self,
         session_id: str,
         message: str,
-        history: List["Message"]
+        history: Sequence[HistoryMessage]
     ) -> AsyncGenerator[str, None]:
         """带上下文的流式聊天（多会话版本）
         
-        每个会话使用独立的 agent。
+        每个会话使用独立的 agent，历史消息只在首次创建 agent 时使用。
         
         Args:
             session_id: 会话 ID
@@ -288,54 +585,109 @@ class ChatService:
         
         try:
             # 获取或创建该会话的 agent
-            agent = self._get_or_create_agent(session_id)
-            
-            logger.debug(f"处理带上下文的流式聊天 (会话: {session_id[:8]}...): {message[:50]}...")
-            logger.debug(f"上下文包含 {len(history)} 条历史消息")
+            agent = self._get_or_create_agent(session_id, history)
+            await self._apply_pending_summary(session_id, agent)
             
-            # 构建完整对话上下文
-            if history:
-                context_messages = []
-                for msg in history:
-                    context_messages.append(f"{msg.role}: {msg.content}")
-                
-                full_prompt = f"以下是之前的对话历史：\n\n" + "\n\n".join(context_messages)
-                full_prompt += f"\n\n现在用户说：{message}\n\n请基于上下文回复用户。"
-            else:
-                full_prompt = message
+            logger.debug("处理带上下文的流式聊天 (会话: {:.8}...): {:.50}...", session_id, message)
+            logger.debug("上下文包含 {} 条历史消息", len(history))
             
-            # 调用流式 API
-            response = agent.run_stream(task=full_prompt)
+            # 调用流式 API（agent 已持有历史，只需传入新消息）
+            response = agent.run_stream(task=TextMessage(source="user", content=message))
             
             chunk_count = 0
-
-            cur_agent = None
-
-            async for chunk in response:
-                pre_agent = cur_agent
-                if isinstance(chunk, ModelClientStreamingChunkEvent) and chunk.source.startswith("quality_agent"):
-                    logger.debug(f"处理流式聊天内容块: {chunk.source} -> {str(chunk)}")
-                    yield chunk.content if pre_agent == chunk.source else f"\n---------------------{chunk.source}--------------------------\n" + chunk.content
-                    cur_agent = chunk.source
-                elif isinstance(chunk, ModelClientStreamingChunkEvent) and chunk.source.startswith("assistant"):
-                    logger.debug(f"处理流式聊天内容块: {chunk.source} -> {str(chunk)}")
-                    yield chunk.content if pre_agent == chunk.source else f"\n---------------------{chunk.source}--------------------------\n" + chunk.content
-                    cur_agent = chunk.source
-                elif isinstance(chunk, TaskResult):
-                    logger.info(f"终止原因为 {chunk.stop_reason}")
             
-            logger.info(f"流式聊天完成 (会话: {session_id[:8]}...)，共生成 {chunk_count} 个内容块")
+            # 后台任务读取模型流并写入队列，与向客户端发送重叠进行
+            queue: asyncio.Queue = asyncio.Queue(maxsize=_STREAM_QUEUE_SIZE)
+            producer = asyncio.create_task(self._produce_stream(response, queue))
+            try:
+                while True:
+                    item = await queue.get()
+                    if item is _STREAM_END:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    chunk_count += 1
+                    yield item
+            finally:
+                # 等待生产者真正结束，避免下一次请求时团队仍在退出 run_stream
+                producer.cancel()
+                await asyncio.wait((producer,))
+            
+            logger.info("流式聊天完成 (会话: {:.8}...)，共生成 {} 个内容块", session_id, chunk_count)
             
         except Exception as e:
             error_msg = f"带上下文流式聊天错误: {str(e)}"
-            logger.error(error_msg, exc_info=True)
+            logger.error("{}", error_msg, exc_info=True)
             yield f"抱歉，发生了错误: {str(e)}"
     
+    async def _produce_stream(self, response: AsyncGenerator[Any, None], queue: asyncio.Queue) -> None:
+        """读取团队的流式输出，逐块写入队列（帧合并由 SSE 层按发送期限完成）
+        
+        正常结束时写入 _STREAM_END，出错时写入异常对象，由消费者重新抛出。
+        
+        Args:
+            response: run_stream 返回的异步生成器
+            queue: 输出队列
+        """
+        try:
+            cur_agent = None
+
+            # 绑定为局部变量，减少逐 token 循环中的全局查找
+            _ChunkEvent = ModelClientStreamingChunkEvent
+            _prefixes = _STREAM_SOURCE_PREFIXES
+            async for chunk in response:
+                if type(chunk) is _ChunkEvent:
+                    source = chunk.source
+                    if source.startswith(_prefixes):
+                        logger.debug("处理流式聊天内容块: {} -> {}", source, chunk)
+                        content = chunk.content if cur_agent == source else f"\n---------------------{source}--------------------------\n" + chunk.content
+                        cur_agent = source
+                        await queue.put(content)
+                elif isinstance(chunk, TaskResult):
+                    logger.info("终止原因为 {}", chunk.stop_reason)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(_STREAM_END)
+    
+    @staticmethod
+    def _title_cache_key(first_message: str) -> bytes:
+        """计算标题缓存的键（规范化后的首条消息哈希）"""
+        return hashlib.blake2b(first_message.strip().lower().encode("utf-8"), digest_size=16).digest()
+    
+    def _remember_title(self, key: bytes, title: str) -> None:
+        """写入标题缓存，超出容量时淘汰最久未使用的条目"""
+        self._title_cache[key] = title
+        if len(self._title_cache) > self.settings.title_cache_size:
+            self._title_cache.popitem(last=False)
+    
+    @staticmethod
+    def _build_title_prompt(first_message: str) -> str:
+        """构建生成标题的提示词"""
+        return _TITLE_PROMPT_TEMPLATE.format(msg=first_message)
+    
+    @staticmethod
+    def _clean_title(raw_title: str) -> str:
+        """清理模型返回的标题（移除引号、换行，限制长度）"""
+        title = raw_title.strip().translate(_TITLE_STRIP_TABLE).strip()
+        
+        # 限制长度
+        if len(title) > 30:
+            title = title[:30] + "..."
+        
+        # 如果标题为空，使用默认值
+        return title or "新对话"
+    
+    @staticmethod
+    def _fallback_title(first_message: str) -> str:
+        """降级方案：使用首条消息的前20个字符"""
+        return first_message[:20] + "..." if len(first_message) > 20 else first_message
+    
     async def generate_title(self, first_message: str) -> str:
         """根据首条消息生成会话标题
         
         使用 AI 生成一个简短、概括性的标题（10-20字）。
-        使用临时 agent，不影响会话状态。
+        直接调用共享的标题模型客户端，不构建 agent，多个会话的标题可并发生成。
         
         Args:
             first_message: 会话的第一条用户消息
@@ -343,63 +695,158 @@ class ChatService:
         Returns:
             生成的标题
         """
-        if not self.initialized or not self.model_client:
+        if not self.initialized or not self.title_model_client:
             raise RuntimeError("聊天服务未初始化")
         
+        key = self._title_cache_key(first_message)
+        if key in self._title_cache:
+            self._title_cache.move_to_end(key)
+            return self._title_cache[key]
+        
         try:
-            logger.debug(f"为消息生成标题: {first_message[:50]}...")
+            logger.debug("为消息生成标题: {:.50}...", first_message)
             
-            # 使用临时 agent 生成标题
-            temp_agent = AssistantAgent(
-                name="title_generator",
-                model_client=self.model_client,
-                system_message="你是一个标题生成助手，专门为对话生成简短准确的标题。",
-            )
+            result = await self.title_model_client.create([
+                SystemMessage(content=_TITLE_SYSTEM_MESSAGE),
+                UserMessage(content=self._build_title_prompt(first_message), source="user"),
+            ])
+            title = self._clean_title(str(result.content))
             
-            prompt = f"""请为以下用户消息生成一个简短的对话标题。
-
-                    要求：
-                    1. 长度：10-20个汉字
-                    2. 准确概括对话主题
-                    3. 只返回标题文本，不要其他内容
-                    4. 不要使用引号或标点符号
-                    
-                    用户消息：
-                    {first_message}
-                    
-                    标题："""
-            
-            response = await temp_agent.run(task=prompt)
-            title = self._extract_response(response).strip()
-            
-            # 清理标题（移除引号、换行等）
-            title = title.replace('"', '').replace("'", '').replace('\n', ' ').strip()
-            
-            # 限制长度
-            if len(title) > 30:
-                title = title[:30] + "..."
-            
-            # 如果标题为空，使用默认值
-            if not title:
-                title = "新对话"
-            
-            logger.info(f"生成的标题: {title}")
+            logger.info("生成的标题: {}", title)
+            self._remember_title(key, title)
             return title
             
         except Exception as e:
-            logger.error(f"标题生成失败: {str(e)}", exc_info=True)
-            # 降级方案：使用首条消息的前20个字符
-            return first_message[:20] + "..." if len(first_message) > 20 else first_message
+            logger.error("标题生成失败: {}", e, exc_info=True)
+            return self._fallback_title(first_message)
+    
+    async def batch_generate_titles(self, messages: List[str]) -> List[str]:
+        """通过 Batch API 批量生成会话标题
+        
+        适用于历史会话标题回填等非实时任务：所有请求合并为一个批量任务提交，
+        成本更低，但完成时间可能较长（最长 24 小时）。实时场景请使用 generate_title。
+        
+        Args:
+            messages: 各会话的首条用户消息
+            
+        Returns:
+            与输入顺序一致的标题列表
+        """
+        if not self.initialized or not self.model_client:
+            raise RuntimeError("聊天服务未初始化")
+        
+        titles: List[Optional[str]] = [None] * len(messages)
+        pending: Dict[str, int] = {}
+        jobs: List[str] = []
+        
+        for index, first_message in enumerate(messages):
+            key = self._title_cache_key(first_message)
+            if key in self._title_cache:
+                titles[index] = self._title_cache[key]
+                continue
+            
+            custom_id = f"title-{index}"
+            pending[custom_id] = index
+            jobs.append(json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    # 与 generate_title 使用相同的标题模型和输出长度限制
+                    "model": self.settings.title_model_name or self.settings.model_name,
+                    "max_tokens": self.settings.title_max_tokens,
+                    "messages": [
+                        {"role": "system", "content": _TITLE_SYSTEM_MESSAGE},
+                        {"role": "user", "content": self._build_title_prompt(first_message)},
+                    ],
+                },
+            }, ensure_ascii=False))
+        
+        if pending:
+            try:
+                logger.info("提交批量标题生成任务，共 {} 条", len(pending))
+                results = await self._run_batch("\n".join(jobs))
+                for custom_id, content in results.items():
+                    index = pending.get(custom_id)
+                    if index is None:
+                        continue
+                    title = self._clean_title(content)
+                    titles[index] = title
+                    self._remember_title(self._title_cache_key(messages[index]), title)
+            except Exception as e:
+                logger.error("批量标题生成失败: {}", e, exc_info=True)
+        
+        return [
+            title if title is not None else self._fallback_title(first_message)
+            for title, first_message in zip(titles, messages)
+        ]
+    
+    async def _run_batch(self, jsonl: str) -> Dict[str, str]:
+        """提交批量任务并等待完成
+        
+        Args:
+            jsonl: 每行一个 /v1/chat/completions 请求的 JSONL 内容
+            
+        Returns:
+            custom_id -> 回复内容 的映射（失败的请求不包含在内）
+        """
+        client = AsyncOpenAI(
+            api_key=self.settings.openai_api_key,
+            base_url=self.settings.openai_api_base or None,
+            http_client=self._http_client,
+        )
+        
+        batch_file = await client.files.create(
+            file=("titles.jsonl", jsonl.encode("utf-8")),
+            purpose="batch",
+        )
+        batch = await client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(self.settings.batch_poll_interval)
+            batch = await client.batches.retrieve(batch.id)
+        
+        if batch.status != "completed" or not batch.output_file_id:
+            raise RuntimeError(f"批量任务未完成 (状态: {batch.status})")
+        
+        output = await client.files.content(batch.output_file_id)
+        
+        results: Dict[str, str] = {}
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if response.get("status_code") != 200:
+                continue
+            results[record["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+        return results
     
     async def cleanup(self) -> None:
         """清理资源"""
         try:
+            if self._warmup_task:
+                self._warmup_task.cancel()
+            self._warmup_task = None
             self.clear_all_agents()
+            self._temp_agents = asyncio.Queue()
+            if self.title_model_client:
+                await self.title_model_client.close()
+            self.title_model_client = None
+            if self.model_client:
+                await self.model_client.close()
             self.model_client = None
+            if self._http_client:
+                await self._http_client.aclose()
+            self._http_client = None
             self.initialized = False
             logger.info("✓ 聊天服务资源已清理")
         except Exception as e:
-            logger.error(f"清理资源时出错: {str(e)}", exc_info=True)
+            logger.error("清理资源时出错: {}", e, exc_info=True)
 
 
 # 用于测试的主函数
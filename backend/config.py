@@ -2,14 +2,18 @@
 配置管理模块
 """
 import os
+from functools import cached_property, lru_cache
 from typing import List
-from pydantic_settings import BaseSettings
+from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import Field
 
 
 class Settings(BaseSettings):
     """应用配置"""
     
+    # 配置在启动后不可修改，实例可哈希并可安全地全局共享
+    model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8", frozen=True)
+    
     # OpenAI 配置
     openai_api_key: str = Field(..., env="OPENAI_API_KEY")
     openai_api_base: str = Field(
@@ -21,6 +25,12 @@ class Settings(BaseSettings):
     # 服务器配置
     host: str = Field(default="0.0.0.0", env="HOST")
     port: int = Field(default=8000, env="PORT")
+    # 开发模式：启用自动重载（单进程）
+    dev: bool = Field(default=False, env="DEV")
+    # 工作进程数；会话 agent 保存在进程内存中，多进程时同一会话的请求可能落到不同进程
+    workers: int = Field(default=1, env="WORKERS")
+    # 是否在 OpenAPI 文档中附带请求/响应示例（仅 /docs 使用；models 在导入时直接读取环境变量）
+    enable_openapi_examples: bool = Field(default=False, env="ENABLE_OPENAPI_EXAMPLES")
     
     # CORS 配置
     cors_origins: str = Field(
@@ -59,28 +69,51 @@ Reason: [这里填写具体的评价理由]
         env="QUALITY_MESSAGE"
     )
     
+    # 上下文历史配置
+    # 创建会话 agent 时，若历史消息超过 history_summary_trigger 条，在后台将较早的消息
+    # 折叠为摘要（使用标题模型），下一轮起只保留最近 history_max_turns 条原文
+    history_max_turns: int = Field(default=10, env="HISTORY_MAX_TURNS")
+    history_summary_trigger: int = Field(default=16, env="HISTORY_SUMMARY_TRIGGER")
+    # 每个 agent 上下文中保留的最大消息数
+    agent_context_size: int = Field(default=20, env="AGENT_CONTEXT_SIZE")
+    # 无会话聊天接口保留的空闲 agent 数量（池空时临时新建，不限制并发）
+    temp_agent_pool_size: int = Field(default=8, env="TEMP_AGENT_POOL_SIZE")
+    
     # 流式输出配置
     stream_chunk_size: int = Field(default=1, env="STREAM_CHUNK_SIZE")
     stream_delay: float = Field(default=0.05, env="STREAM_DELAY")
+    # SSE 帧合并：缓冲达到字节数或距上次发送超过间隔（秒）时发送
+    sse_flush_bytes: int = Field(default=4096, env="SSE_FLUSH_BYTES")
+    sse_flush_interval: float = Field(default=0.015, env="SSE_FLUSH_INTERVAL")
+
+    # 语义缓存配置
+    semantic_cache_enabled: bool = Field(default=True, env="SEMANTIC_CACHE_ENABLED")
+    semantic_cache_size: int = Field(default=1024, env="SEMANTIC_CACHE_SIZE")
+    semantic_cache_prefetch_k: int = Field(default=4, env="SEMANTIC_CACHE_PREFETCH_K")  # 0 表示不预取
+    title_cache_size: int = Field(default=1024, env="TITLE_CACHE_SIZE")
     
+    # 标题生成配置
+    title_model_name: str = Field(default="", env="TITLE_MODEL_NAME")  # 为空时使用 model_name
+    title_max_tokens: int = Field(default=32, env="TITLE_MAX_TOKENS")
+    
+    # 批量任务配置
+    batch_poll_interval: float = Field(default=30.0, env="BATCH_POLL_INTERVAL")  # 轮询间隔（秒）
+
     # 日志配置 (loguru)
     log_dir: str = Field(default="logs", env="LOG_DIR")
     log_level: str = Field(default="DEBUG", env="LOG_LEVEL")
     log_rotation: str = Field(default="10 MB", env="LOG_ROTATION")  # 日志轮转大小
     log_retention: str = Field(default="7 days", env="LOG_RETENTION")  # 日志保留时间
     
-    @property
+    @cached_property
     def cors_origins_list(self) -> List[str]:
         """将 CORS 源字符串转换为列表"""
-        return [origin.strip() for origin in self.cors_origins.split(",")]
-    
-    class Config:
-        env_file = ".env"
-        env_file_encoding = "utf-8"
+        return [origin.strip() for origin in self.cors_origins.split(",") if origin.strip()]
 
 
 # 创建全局配置实例
+@lru_cache(maxsize=1)
 def get_settings() -> Settings:
-    """获取配置实例"""
+    """获取配置实例（只在首次调用时读取 .env 并校验）"""
     return Settings()
 
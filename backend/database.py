@@ -5,9 +5,10 @@
 import uuid
 from datetime import datetime
 from pathlib import Path
-from typing import List
+from typing import AsyncIterator, List
 
-from sqlalchemy import Column, String, DateTime, Text, ForeignKey, create_engine
+from sqlalchemy import Column, String, DateTime, Text, ForeignKey, Index, create_engine, event, func
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, Mapped, mapped_column
@@ -21,11 +22,19 @@ class Session(Base):
     
     id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
     title: Mapped[str] = mapped_column(String(200), nullable=False)
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.now, nullable=False)
+    # 时间由数据库生成（CURRENT_TIMESTAMP，UTC）；
+    # 使用 SQL 表达式作为 default 而非 server_default，兼容已建好的旧表
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime,
+        default=func.now(),
+        server_default=func.now(),
+        nullable=False
+    )
     updated_at: Mapped[datetime] = mapped_column(
         DateTime, 
-        default=datetime.now,
-        onupdate=datetime.now,
+        default=func.now(),
+        server_default=func.now(),
+        onupdate=func.now(),
         nullable=False
     )
     
@@ -44,11 +53,18 @@ class Session(Base):
 class Message(Base):
     """消息表模型"""
     __tablename__ = 'messages'
+    __table_args__ = (
+        # 按会话取最近消息（ORDER BY timestamp）
+        Index("ix_messages_session_ts", "session_id", "timestamp"),
+        # 按会话取首条用户消息（role + ORDER BY timestamp）
+        Index("ix_messages_session_role_ts", "session_id", "role", "timestamp"),
+    )
     
     id: Mapped[str] = mapped_column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
     session_id: Mapped[str] = mapped_column(String(36), ForeignKey('sessions.id'), nullable=False)
     role: Mapped[str] = mapped_column(String(20), nullable=False)  # 'user' or 'assistant'
-    content: Mapped[str] = mapped_column(Text, nullable=False)
+    content: Mapped[str] = mapped_column(Text, nullable=False, deferred=True)  # 按需加载，需要时使用 undefer
+    # 消息是会话内的排序键，需要亚秒级精度，因此仍在 Python 端生成（CURRENT_TIMESTAMP 只精确到秒）
     timestamp: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, nullable=False)
     
     # 关系：消息属于一个会话
@@ -63,13 +79,36 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 DATABASE_PATH = BASE_DIR / "backend" / "data" / "chat.db"
 DATABASE_URL = f"sqlite+aiosqlite:///{DATABASE_PATH}"
 
+# SQLite 连接参数：WAL 模式下读写互不阻塞，synchronous=NORMAL 避免每次提交都 fsync
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",  # 256 MB
+    "PRAGMA cache_size=-64000",  # 约 64 MB
+)
+
 # 创建异步引擎
 async_engine = create_async_engine(
     DATABASE_URL,
     echo=False,  # 设为 True 可以看到 SQL 语句
-    future=True
+    future=True,
+    connect_args={"check_same_thread": False},
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=20,
+    max_overflow=40,
+    pool_pre_ping=False
 )
 
+
+@event.listens_for(async_engine.sync_engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    """为每个新建立的 SQLite 连接设置 PRAGMA"""
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
 # 创建异步会话工厂
 AsyncSessionLocal = async_sessionmaker(
     async_engine,
@@ -78,8 +117,8 @@ AsyncSessionLocal = async_sessionmaker(
 )
 
 
-async def get_db() -> AsyncSession:
-    """获取数据库会话的依赖函数"""
+async def get_db() -> AsyncIterator[AsyncSession]:
+    """获取数据库会话的依赖函数（每个请求一个会话，请求结束时提交并关闭）"""
     async with AsyncSessionLocal() as session:
         try:
             yield session
@@ -95,5 +134,8 @@ async def init_db() -> None:
     """初始化数据库，创建所有表"""
     async with async_engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        # create_all 不会为已存在的表补建索引，这里单独执行 CREATE INDEX IF NOT EXISTS
+        for index in Message.__table__.indexes:
+            await conn.run_sync(index.create, checkfirst=True)
     print("✓ 数据库表创建完成")
 
@@ -2,16 +2,23 @@
 数据库操作层
 提供会话和消息的 CRUD 操作
 """
-import json
-from datetime import datetime
-from typing import List, Optional
-from sqlalchemy import select, delete, update, desc
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence, Tuple
+import orjson
+from cachetools import TTLCache
+from sqlalchemy import Row, select, insert, delete, update, desc, func
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import selectinload, undefer
 
 from database import Session, Message
 
 
+# 会话存在性缓存：session_id -> True，进程内共享；删除或修改会话时失效
+# 失效只发生在当前进程内：多 worker 部署时其他进程删除会话后，这里最多 TTL 秒内仍判定为存在。
+# 因此写入消息时不依赖该缓存，而是由 add_message / add_messages 在事务内再次确认会话存在。
+_session_exists_cache: TTLCache = TTLCache(maxsize=10_000, ttl=5)
+
+
 class DatabaseManager:
     """数据库管理类，提供所有数据库操作"""
     
@@ -33,54 +40,94 @@ class DatabaseManager:
         await self.db.refresh(new_session)
         return new_session
     
-    async def get_session(self, session_id: str) -> Optional[Session]:
+    async def get_session(self, session_id: str, with_messages: bool = True) -> Optional[Session]:
         """获取单个会话
         
         Args:
             session_id: 会话 ID
+            with_messages: 是否同时加载会话的全部消息
             
         Returns:
             会话对象，如果不存在则返回 None
         """
+        stmt = select(Session).where(Session.id == session_id)
+        if with_messages:
+            stmt = stmt.options(selectinload(Session.messages).options(undefer(Message.content)))
+        result = await self.db.execute(stmt)
+        return result.scalar_one_or_none()
+    
+    async def session_exists(self, session_id: str) -> bool:
+        """检查会话是否存在
+        
+        结果在进程内缓存几秒，命中时不访问数据库。缓存只在单个 worker 内一致，
+        写入前的最终校验由 add_message / add_messages 完成。
+        
+        Args:
+            session_id: 会话 ID
+            
+        Returns:
+            会话是否存在
+        """
+        if session_id in _session_exists_cache:
+            return True
+        
         result = await self.db.execute(
-            select(Session)
-            .options(selectinload(Session.messages))
-            .where(Session.id == session_id)
+            select(1).where(Session.id == session_id).limit(1)
         )
-        return result.scalar_one_or_none()
+        exists = result.first() is not None
+        if exists:
+            _session_exists_cache[session_id] = True
+        return exists
     
-    async def get_all_sessions(self, limit: int = 100) -> List[Session]:
-        """获取所有会话列表，按更新时间倒序
+    async def get_all_sessions_with_counts(self, limit: int = 100) -> List[Row]:
+        """获取会话列表及每个会话的消息数量，按更新时间倒序
+        
+        消息数量通过关联子查询在同一条 SQL 中统计，只对返回的会话计数。
         
         Args:
             limit: 返回的最大会话数量
             
         Returns:
-            会话列表
+            会话行列表（包含 id、title、created_at、updated_at、message_count）
         """
+        message_count = (
+            select(func.count(Message.id))
+            .where(Message.session_id == Session.id)
+            .correlate(Session)
+            .scalar_subquery()
+            .label("message_count")
+        )
         result = await self.db.execute(
-            select(Session)
+            select(Session.id, Session.title, Session.created_at, Session.updated_at, message_count)
             .order_by(desc(Session.updated_at))
             .limit(limit)
         )
-        return list(result.scalars().all())
+        return list(result.all())
     
-    async def update_session_title(self, session_id: str, title: str) -> bool:
+    async def update_session_title(
+        self,
+        session_id: str,
+        title: str,
+        expected_title: Optional[str] = None
+    ) -> bool:
         """更新会话标题
         
         Args:
             session_id: 会话 ID
             title: 新标题
+            expected_title: 仅当当前标题等于该值时才更新（None 表示无条件更新）
             
         Returns:
             是否更新成功
         """
+        stmt = update(Session).where(Session.id == session_id)
+        if expected_title is not None:
+            stmt = stmt.where(Session.title == expected_title)
         result = await self.db.execute(
-            update(Session)
-            .where(Session.id == session_id)
-            .values(title=title, updated_at=datetime.utcnow())
+            stmt.values(title=title, updated_at=func.now())
         )
         await self.db.commit()
+        _session_exists_cache.pop(session_id, None)
         return result.rowcount > 0
     
     async def delete_session(self, session_id: str) -> bool:
@@ -96,14 +143,54 @@ class DatabaseManager:
             delete(Session).where(Session.id == session_id)
         )
         await self.db.commit()
+        _session_exists_cache.pop(session_id, None)
         return result.rowcount > 0
     
+    async def get_untitled_sessions(self, default_title: str = "新对话", limit: int = 1000) -> List[Row]:
+        """获取仍使用默认标题且已有用户消息的会话（用于标题回填）
+        
+        Args:
+            default_title: 默认标题
+            limit: 返回的最大会话数量
+            
+        Returns:
+            会话行列表（包含 id、first_message）
+        """
+        first_message = (
+            select(Message.content)
+            .where(Message.session_id == Session.id, Message.role == "user")
+            .order_by(Message.timestamp)
+            .limit(1)
+            .correlate(Session)
+            .scalar_subquery()
+        )
+        result = await self.db.execute(
+            select(Session.id, first_message.label("first_message"))
+            .where(Session.title == default_title, first_message.is_not(None))
+            .limit(limit)
+        )
+        return list(result.all())
+    
+    async def set_session_titles(self, titles: Dict[str, str]) -> None:
+        """批量设置会话标题，不修改会话的更新时间（用于标题回填）
+        
+        Args:
+            titles: 会话 ID -> 新标题
+        """
+        for session_id, title in titles.items():
+            await self.db.execute(
+                update(Session)
+                .where(Session.id == session_id)
+                .values(title=title, updated_at=Session.updated_at)
+            )
+        await self.db.commit()
+    
     async def add_message(
         self, 
         session_id: str, 
         role: str, 
         content: str
-    ) -> Message:
+    ) -> Optional[Message]:
         """添加消息到会话
         
         Args:
@@ -112,25 +199,80 @@ class DatabaseManager:
             content: 消息内容
             
         Returns:
-            创建的消息对象
+            创建的消息对象，如果会话已不存在则返回 None
         """
+        # 更新会话的 updated_at 时间，同时确认会话仍然存在
+        if not await self._touch_session(session_id):
+            return None
+        
         new_message = Message(
             session_id=session_id,
             role=role,
             content=content
         )
         self.db.add(new_message)
+        await self.db.commit()
+        return new_message
+    
+    async def add_messages(
+        self,
+        session_id: str,
+        pairs: Sequence[Tuple[str, str]]
+    ) -> bool:
+        """在同一个事务中批量添加消息（如一轮对话的用户消息和 AI 回复）
+        
+        使用一条 executemany INSERT 写入，不构建 ORM 对象。
+        
+        Args:
+            session_id: 会话 ID
+            pairs: (角色, 内容) 列表，按时间顺序排列
+            
+        Returns:
+            是否写入成功（会话已不存在时返回 False）
+        """
+        # 更新会话的 updated_at 时间，同时确认会话仍然存在
+        if not await self._touch_session(session_id):
+            return False
         
-        # 更新会话的 updated_at 时间
+        # 同一批消息的时间戳依次递增，保证按时间排序时顺序不变
+        now = datetime.utcnow()
         await self.db.execute(
+            insert(Message),
+            [
+                {
+                    "session_id": session_id,
+                    "role": role,
+                    "content": content,
+                    "timestamp": now + timedelta(microseconds=index)
+                }
+                for index, (role, content) in enumerate(pairs)
+            ]
+        )
+        await self.db.commit()
+        return True
+    
+    async def _touch_session(self, session_id: str) -> bool:
+        """更新会话的 updated_at 时间（写入消息前调用，不提交）
+        
+        SQLite 未启用外键约束，通过 UPDATE 的影响行数在同一事务内确认会话存在，
+        避免向已删除的会话写入孤立消息。
+        
+        Args:
+            session_id: 会话 ID
+            
+        Returns:
+            会话是否存在（不存在时已回滚事务并清除存在性缓存）
+        """
+        result = await self.db.execute(
             update(Session)
             .where(Session.id == session_id)
-            .values(updated_at=datetime.utcnow())
+            .values(updated_at=func.now())
         )
-        
-        await self.db.commit()
-        await self.db.refresh(new_message)
-        return new_message
+        if result.rowcount == 0:
+            await self.db.rollback()
+            _session_exists_cache.pop(session_id, None)
+            return False
+        return True
     
     async def get_session_messages(
         self, 
@@ -149,6 +291,7 @@ class DatabaseManager:
         # 先获取最近的 limit 条消息（倒序）
         result = await self.db.execute(
             select(Message)
+            .options(undefer(Message.content))
             .where(Message.session_id == session_id)
             .order_by(desc(Message.timestamp))
             .limit(limit)
@@ -158,6 +301,30 @@ class DatabaseManager:
         # 反转列表，使其按时间正序排列
         return list(reversed(messages))
     
+    async def get_session_messages_for_context(
+        self,
+        session_id: str,
+        limit: int = 20
+    ) -> List[Row]:
+        """获取构建对话上下文所需的最近 N 条消息（只查询角色和内容）
+        
+        Args:
+            session_id: 会话 ID
+            limit: 返回的最大消息数量（最近的 N 条）
+            
+        Returns:
+            (role, content) 行列表，按时间顺序排列
+        """
+        result = await self.db.execute(
+            select(Message.role, Message.content)
+            .where(Message.session_id == session_id)
+            .order_by(desc(Message.timestamp))
+            .limit(limit)
+        )
+        rows = result.all()
+        rows.reverse()
+        return rows
+    
     async def get_first_user_message(self, session_id: str) -> Optional[Message]:
         """获取会话的第一条用户消息（用于生成标题）
         
@@ -169,6 +336,7 @@ class DatabaseManager:
         """
         result = await self.db.execute(
             select(Message)
+            .options(undefer(Message.content))
             .where(Message.session_id == session_id)
             .where(Message.role == "user")
             .order_by(Message.timestamp)
@@ -176,6 +344,33 @@ class DatabaseManager:
         )
         return result.scalar_one_or_none()
     
+    async def _get_export_rows(
+        self,
+        session_id: str
+    ) -> Tuple[Optional[Row], Sequence[Row]]:
+        """按列查询导出所需的会话和消息数据（不构建 ORM 实例）
+        
+        Args:
+            session_id: 会话 ID
+            
+        Returns:
+            (会话行, 按时间排序的消息行)，会话不存在时会话行为 None
+        """
+        session_result = await self.db.execute(
+            select(Session.id, Session.title, Session.created_at, Session.updated_at)
+            .where(Session.id == session_id)
+        )
+        session = session_result.first()
+        if session is None:
+            return None, []
+        
+        message_result = await self.db.execute(
+            select(Message.id, Message.role, Message.content, Message.timestamp)
+            .where(Message.session_id == session_id)
+            .order_by(Message.timestamp)
+        )
+        return session, message_result.all()
+    
     async def export_session_json(self, session_id: str) -> Optional[str]:
         """导出会话为 JSON 格式
         
@@ -185,27 +380,28 @@ class DatabaseManager:
         Returns:
             JSON 字符串，如果会话不存在则返回 None
         """
-        session = await self.get_session(session_id)
-        if not session:
+        session, messages = await self._get_export_rows(session_id)
+        if session is None:
             return None
         
         export_data = {
             "id": session.id,
             "title": session.title,
-            "created_at": session.created_at.isoformat(),
-            "updated_at": session.updated_at.isoformat(),
+            "created_at": session.created_at,
+            "updated_at": session.updated_at,
             "messages": [
                 {
                     "id": msg.id,
                     "role": msg.role,
                     "content": msg.content,
-                    "timestamp": msg.timestamp.isoformat()
+                    "timestamp": msg.timestamp
                 }
-                for msg in session.messages
+                for msg in messages
             ]
         }
         
-        return json.dumps(export_data, ensure_ascii=False, indent=2)
+        # orjson 原生支持 datetime，且默认输出 UTF-8（等价于 ensure_ascii=False）
+        return orjson.dumps(export_data, option=orjson.OPT_INDENT_2).decode()
     
     async def export_session_markdown(self, session_id: str) -> Optional[str]:
         """导出会话为 Markdown 格式
@@ -216,32 +412,26 @@ class DatabaseManager:
         Returns:
             Markdown 字符串，如果会话不存在则返回 None
         """
-        session = await self.get_session(session_id)
-        if not session:
+        session, messages = await self._get_export_rows(session_id)
+        if session is None:
             return None
         
-        lines = [
-            f"# {session.title}",
-            "",
-            f"**创建时间**: {session.created_at.strftime('%Y-%m-%d %H:%M:%S')}",
-            f"**更新时间**: {session.updated_at.strftime('%Y-%m-%d %H:%M:%S')}",
-            "",
-            "---",
-            ""
-        ]
-        
-        for msg in session.messages:
+        time_format = '%Y-%m-%d %H:%M:%S'
+        header = (
+            f"# {session.title}\n\n"
+            f"**创建时间**: {session.created_at.strftime(time_format)}\n"
+            f"**更新时间**: {session.updated_at.strftime(time_format)}\n\n"
+            "---\n"
+        )
+        
+        # 每条消息格式化为一个完整的片段，最后一次性拼接
+        parts = []
+        for msg in messages:
             role_name = "用户" if msg.role == "user" else "AI 助手"
-            time_str = msg.timestamp.strftime('%Y-%m-%d %H:%M:%S')
-            
-            lines.append(f"## {role_name} ({time_str})")
-            lines.append("")
-            lines.append(msg.content)
-            lines.append("")
-            lines.append("---")
-            lines.append("")
-        
-        return "\n".join(lines)
+            time_str = msg.timestamp.strftime(time_format)
+            parts.append(f"\n## {role_name} ({time_str})\n\n{msg.content}\n\n---\n")
+        
+        return header + "".join(parts)
     
     async def count_session_messages(self, session_id: str) -> int:
         """统计会话的消息数量
@@ -253,8 +443,8 @@ class DatabaseManager:
             消息数量
         """
         result = await self.db.execute(
-            select(Message)
+            select(func.count(Message.id))
             .where(Message.session_id == session_id)
         )
-        return len(list(result.scalars().all()))
+        return result.scalar_one()
 
@@ -35,7 +35,8 @@ def setup_logger(
                "<level>{level: <8}</level> | "
                "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> | "
                "<level>{message}</level>",
-        colorize=True
+        colorize=True,
+        enqueue=True,  # 在后台线程写出，避免阻塞事件循环
     )
     
     # 添加文件处理器 - 普通日志
@@ -60,7 +61,7 @@ def setup_logger(
         enqueue=True,
     )
     
-    logger.info(f"日志系统已初始化 - 日志目录: {log_path.absolute()}, 级别: {log_level}")
+    logger.info("日志系统已初始化 - 日志目录: {}, 级别: {}", log_path.absolute(), log_level)
 
 
 # 导出 logger 供其他模块使用
@@ -3,36 +3,110 @@ FastAPI 后端服务器
 提供 SSE 流式输出的 AI 聊天接口
 """
 import asyncio
-import json
-from typing import AsyncGenerator, Optional, Dict, Any, List
+from typing import AsyncGenerator, Callable, Optional, Dict, Any, List, Set
 from contextlib import asynccontextmanager
 from collections.abc import AsyncIterator
 
-from fastapi import FastAPI, HTTPException, status, Request
+from fastapi import Depends, FastAPI, HTTPException, status, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import Response, StreamingResponse, ORJSONResponse
 from dotenv import load_dotenv
+from pydantic import TypeAdapter, ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
+import orjson
+
+# 加载环境变量（需在导入本地模块之前，models 在导入时读取 ENABLE_OPENAPI_EXAMPLES）
+load_dotenv()
 
 from chat_service import ChatService
 from config import get_settings, Settings
 from models import (
-    ChatRequest, ChatResponse, HealthResponse, ErrorResponse,
+    ChatRequest, CHAT_REQUEST_ADAPTER, ChatResponse, HealthResponse, ErrorResponse,
     SessionCreate, SessionResponse, SessionList, MessageResponse,
-    ChatRequestWithSession, UpdateSessionTitle, ExportFormat, ExportResponse
+    ChatRequestWithSession, UpdateSessionTitle, ExportFormat, ExportResponse,
+    stream_chunk_json
 )
 from database import get_db, init_db, AsyncSessionLocal, Session as DBSession, Message as DBMessage
 from db_operations import DatabaseManager
 from logger import logger, setup_logger
 
-# 加载环境变量
-load_dotenv()
-
 # 获取配置
 settings: Settings = get_settings()
 
+# 流式输出热路径使用的配置，导入时绑定一次，避免逐块访问配置对象属性
+_SSE_FLUSH_BYTES: int = settings.sse_flush_bytes
+_SSE_FLUSH_INTERVAL: float = settings.sse_flush_interval
+
+
+def _err_frame(message: str) -> bytes:
+    """构建 SSE 错误帧，只对错误信息做 JSON 转义"""
+    return b'data: {"error":' + orjson.dumps(message) + b'}\n\n'
+
+
+# 预先编码的固定 SSE 帧
+_DONE = b"data: [DONE]\n\n"
+_ERR_NOT_INIT = _err_frame("聊天服务未初始化")
+_ERR_NO_SESSION = _err_frame("会话不存在")
+
+
+# 消息列表序列化器（模块加载时构建一次）
+_MESSAGE_LIST_ADAPTER = TypeAdapter(List[MessageResponse])
+
+# 聊天接口的请求体在 OpenAPI 文档中的描述（请求体由 parse_chat_request 自行解析）
+_CHAT_REQUEST_OPENAPI: Dict[str, Any] = {
+    "requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": ChatRequest.model_json_schema()}},
+    }
+}
+
+# 新会话的默认标题（后台标题生成只替换该标题）
+_DEFAULT_TITLE = "新对话"
+
 # 全局聊天服务实例
 chat_service: Optional[ChatService] = None
 
+# 后台标题生成任务：session_id -> task
+_title_tasks: Dict[str, asyncio.Task] = {}
+
+# 其他后台任务（保持引用，避免任务被提前回收）
+_background_tasks: Set[asyncio.Task] = set()
+
+
+async def _finalize_title(session_id: str, first_message: str) -> str:
+    """后台生成会话标题并写入数据库
+    
+    只在会话仍使用默认标题时写入，不覆盖创建会话时指定或用户修改过的标题。
+    
+    Args:
+        session_id: 会话 ID
+        first_message: 会话的第一条用户消息
+        
+    Returns:
+        生成的标题
+    """
+    title = await chat_service.generate_title(first_message)
+    async with AsyncSessionLocal() as db:
+        await DatabaseManager(db).update_session_title(session_id, title, expected_title=_DEFAULT_TITLE)
+    return title
+
+
+def _on_title_done(session_id: str, task: asyncio.Task) -> None:
+    """标题任务结束回调：移除任务并记录异常"""
+    _title_tasks.pop(session_id, None)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("后台标题生成失败（会话: {}）: {}", session_id, task.exception())
+
+
+def schedule_title_generation(session_id: str, first_message: str) -> None:
+    """在后台为会话生成标题，不阻塞聊天请求"""
+    if session_id in _title_tasks:
+        return
+    task = asyncio.create_task(_finalize_title(session_id, first_message))
+    _title_tasks[session_id] = task
+    task.add_done_callback(lambda t: _on_title_done(session_id, t))
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncIterator[None]:
@@ -53,7 +127,7 @@ async def lifespan(app: FastAPI) -> AsyncIterator[None]:
         await init_db()
         logger.info("✓ 数据库初始化完成")
     except Exception as e:
-        logger.error(f"✗ 数据库初始化失败: {str(e)}")
+        logger.error("✗ 数据库初始化失败: {}", e)
         raise
     
     # 启动时初始化 AutoGen 聊天服务
@@ -63,18 +137,20 @@ async def lifespan(app: FastAPI) -> AsyncIterator[None]:
         await chat_service.initialize()
         logger.info("✓ AutoGen 聊天服务初始化完成")
     except Exception as e:
-        logger.error(f"✗ 初始化失败: {str(e)}")
+        logger.error("✗ 初始化失败: {}", e)
         raise
     
     yield
     
     # 关闭时清理
     logger.info("正在关闭聊天服务...")
+    for task in list(_title_tasks.values()):
+        task.cancel()
     try:
         await chat_service.cleanup()
         logger.info("✓ 聊天服务已关闭")
     except Exception as e:
-        logger.error(f"清理资源时出错: {str(e)}")
+        logger.error("清理资源时出错: {}", e)
 
 
 # 创建 FastAPI 应用
@@ -82,39 +158,61 @@ app = FastAPI(
     title="AI Chat API",
     description="基于 AutoGen 的 AI 聊天 API，支持 SSE 流式输出",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
-# 配置 CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=settings.cors_origins_list,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# 配置 CORS（前端经同源代理访问时可将 CORS_ORIGINS 置空，省去中间件开销）
+if settings.cors_origins_list:
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=settings.cors_origins_list,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
 
 
 # 异常处理器
 @app.exception_handler(HTTPException)
-async def http_exception_handler(request: Request, exc: HTTPException) -> JSONResponse:
+async def http_exception_handler(request: Request, exc: HTTPException) -> ORJSONResponse:
     """HTTP 异常处理"""
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=exc.status_code,
         content={"error": exc.detail}
     )
 
 
 @app.exception_handler(Exception)
-async def general_exception_handler(request: Request, exc: Exception) -> JSONResponse:
+async def general_exception_handler(request: Request, exc: Exception) -> ORJSONResponse:
     """通用异常处理"""
-    logger.error(f"未处理的异常: {str(exc)}", exc_info=True)
-    return JSONResponse(
+    logger.error("未处理的异常: {}", exc, exc_info=True)
+    return ORJSONResponse(
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
         content={"error": "服务器内部错误", "detail": str(exc)}
     )
 
 
+async def parse_chat_request(http_request: Request) -> ChatRequest:
+    """解析聊天请求体
+    
+    原始字节直接交给 pydantic-core 的 JSON 校验器，省去 json.loads 和中间字典。
+    
+    Args:
+        http_request: HTTP 请求
+        
+    Returns:
+        校验后的聊天请求
+    """
+    try:
+        return CHAT_REQUEST_ADAPTER.validate_json(await http_request.body())
+    except ValidationError as e:
+        # 与 FastAPI 默认的请求体校验错误格式保持一致
+        raise RequestValidationError(
+            [{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)]
+        )
+
+
 @app.get("/")
 async def root() -> Dict[str, Any]:
     """根路径"""
@@ -132,16 +230,11 @@ async def root() -> Dict[str, Any]:
 async def health_check() -> HealthResponse:
     """健康检查"""
     is_healthy: bool = chat_service is not None and chat_service.initialized
-    return HealthResponse(
-        status="healthy" if is_healthy else "unhealthy",
-        service="chat-api",
-        autogen_initialized=is_healthy,
-        version="1.0.0"
-    )
+    return HealthResponse.build(is_healthy)
 
 
-@app.post("/api/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest) -> ChatResponse:
+@app.post("/api/chat", response_model=ChatResponse, openapi_extra=_CHAT_REQUEST_OPENAPI)
+async def chat(request: ChatRequest = Depends(parse_chat_request)) -> ChatResponse:
     """非流式聊天接口"""
     if not chat_service or not chat_service.initialized:
         logger.error("聊天服务未初始化")
@@ -151,48 +244,107 @@ async def chat(request: ChatRequest) -> ChatResponse:
         )
     
     try:
-        logger.info(f"收到聊天请求: {request.message[:50]}...")
+        logger.debug("收到聊天请求: {:.50}...", request.message)
         response = await chat_service.chat(request.message)
-        logger.info(f"聊天响应: {response[:50]}...")
-        return ChatResponse(content=response)
+        logger.debug("聊天响应: {:.50}...", response)
+        return ChatResponse.build(response)
     except Exception as e:
-        logger.error(f"聊天失败: {str(e)}", exc_info=True)
+        logger.error("聊天失败: {}", e, exc_info=True)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"聊天失败: {str(e)}"
         )
 
 
-async def event_generator(message: str) -> AsyncGenerator[str, None]:
+async def _sse_frames(
+    chunks: AsyncIterator[str],
+    on_chunk: Optional[Callable[[str], None]] = None
+) -> AsyncGenerator[bytes, None]:
+    """将内容块编码为 SSE 帧，合并多个帧后再发送
+    
+    减少 ASGI 消息和 write 系统调用次数。缓冲达到 _SSE_FLUSH_BYTES 时立即发送；
+    否则最多等待 _SSE_FLUSH_INTERVAL 秒，到期时即使上游暂时没有新内容也会发送，
+    已缓冲的内容不会因上游停顿而滞留。
+    
+    Args:
+        chunks: 内容块异步迭代器
+        on_chunk: 每收到一个内容块时调用（如收集完整回复）
+        
+    Yields:
+        合并后的 SSE 帧
+    """
+    loop = asyncio.get_running_loop()
+    iterator = chunks.__aiter__()
+    buf = bytearray()
+    deadline = 0.0
+    pending: Optional[asyncio.Future] = None
+    
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            # 缓冲为空时一直等待下一个内容块，否则最多等到发送期限
+            timeout = max(0.0, deadline - loop.time()) if buf else None
+            done, _ = await asyncio.wait((pending,), timeout=timeout)
+            if not done:
+                yield bytes(buf)
+                buf.clear()
+                continue
+            
+            task, pending = pending, None
+            try:
+                chunk = task.result()
+            except StopAsyncIteration:
+                break
+            except Exception:
+                # 先发送已缓冲的内容，再由调用方发送错误帧
+                if buf:
+                    yield bytes(buf)
+                raise
+            
+            if on_chunk is not None:
+                on_chunk(chunk)
+            if not buf:
+                deadline = loop.time() + _SSE_FLUSH_INTERVAL
+            buf += b"data: " + stream_chunk_json(chunk) + b"\n\n"
+            if len(buf) >= _SSE_FLUSH_BYTES:
+                yield bytes(buf)
+                buf.clear()
+        
+        if buf:
+            yield bytes(buf)
+    finally:
+        # 客户端断开时取消仍在读取上游的任务
+        if pending is not None:
+            pending.cancel()
+            await asyncio.wait((pending,))
+
+
+async def event_generator(message: str) -> AsyncGenerator[bytes, None]:
     """SSE 事件生成器"""
     if not chat_service or not chat_service.initialized:
         logger.error("聊天服务未初始化")
-        yield f"data: {json.dumps({'error': '聊天服务未初始化'})}\n\n"
+        yield _ERR_NOT_INIT
         return
     
     try:
-        logger.info(f"开始流式聊天: {message[:50]}...")
-        chunk_count = 0
+        logger.debug("开始流式聊天: {:.50}...", message)
         
-        async for chunk in chat_service.stream_chat(message):
-            # 发送数据块
-            yield f"data: {json.dumps({'content': chunk, 'role': 'assistant'})}\n\n"
-            chunk_count += 1
-            # 添加小延迟以避免数据过快
-            await asyncio.sleep(settings.stream_delay)
+        async for frames in _sse_frames(chat_service.stream_chat(message)):
+            yield frames
         
-        logger.info(f"流式聊天完成，共发送 {chunk_count} 个数据块")
+        logger.debug("流式聊天完成")
         # 发送完成标志
-        yield "data: [DONE]\n\n"
+        yield _DONE
         
     except Exception as e:
         error_message = f"流式聊天错误: {str(e)}"
-        logger.error(error_message, exc_info=True)
-        yield f"data: {json.dumps({'error': error_message})}\n\n"
+        logger.error("{}", error_message, exc_info=True)
+        yield _err_frame(error_message)
 
 
-@app.post("/api/chat/stream")
-async def stream_chat(request: ChatRequest) -> StreamingResponse:
+@app.post("/api/chat/stream", openapi_extra=_CHAT_REQUEST_OPENAPI)
+async def stream_chat(request: ChatRequest = Depends(parse_chat_request)) -> StreamingResponse:
     """SSE 流式聊天接口"""
     if not chat_service or not chat_service.initialized:
         raise HTTPException(
@@ -215,162 +367,167 @@ async def stream_chat(request: ChatRequest) -> StreamingResponse:
 # ============= 会话管理 API =============
 
 @app.post("/api/sessions", response_model=SessionResponse)
-async def create_session(request: SessionCreate) -> SessionResponse:
+async def create_session(
+    request: SessionCreate,
+    db: AsyncSession = Depends(get_db)
+) -> SessionResponse:
     """创建新会话"""
-    async with AsyncSessionLocal() as db:
-        db_manager = DatabaseManager(db)
-        session = await db_manager.create_session(title=request.title or "新对话")
-        
-        return SessionResponse(
-            id=session.id,
-            title=session.title,
-            created_at=session.created_at,
-            updated_at=session.updated_at,
-            message_count=0
-        )
+    db_manager = DatabaseManager(db)
+    session = await db_manager.create_session(title=request.title or _DEFAULT_TITLE)
+    
+    return SessionResponse(
+        id=session.id,
+        title=session.title,
+        created_at=session.created_at,
+        updated_at=session.updated_at,
+        message_count=0
+    )
 
 
 @app.get("/api/sessions", response_model=SessionList)
-async def get_sessions() -> SessionList:
+async def get_sessions(db: AsyncSession = Depends(get_db)) -> SessionList:
     """获取所有会话列表"""
-    async with AsyncSessionLocal() as db:
-        db_manager = DatabaseManager(db)
-        sessions = await db_manager.get_all_sessions(limit=100)
-        
-        session_responses = []
-        for session in sessions:
-            msg_count = await db_manager.count_session_messages(session.id)
-            session_responses.append(SessionResponse(
-                id=session.id,
-                title=session.title,
-                created_at=session.created_at,
-                updated_at=session.updated_at,
-                message_count=msg_count
-            ))
-        
-        return SessionList(
-            sessions=session_responses,
-            total=len(session_responses)
+    db_manager = DatabaseManager(db)
+    sessions = await db_manager.get_all_sessions_with_counts(limit=100)
+    
+    session_responses = [
+        SessionResponse(
+            id=session.id,
+            title=session.title,
+            created_at=session.created_at,
+            updated_at=session.updated_at,
+            message_count=session.message_count
         )
+        for session in sessions
+    ]
+    
+    return SessionList(
+        sessions=session_responses,
+        total=len(session_responses)
+    )
 
 
 @app.get("/api/sessions/{session_id}", response_model=SessionResponse)
-async def get_session(session_id: str) -> SessionResponse:
+async def get_session(
+    session_id: str,
+    db: AsyncSession = Depends(get_db)
+) -> SessionResponse:
     """获取单个会话详情"""
-    async with AsyncSessionLocal() as db:
-        db_manager = DatabaseManager(db)
-        session = await db_manager.get_session(session_id)
-        
-        if not session:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="会话不存在"
-            )
-        
-        msg_count = len(session.messages)
-        
-        return SessionResponse(
-            id=session.id,
-            title=session.title,
-            created_at=session.created_at,
-            updated_at=session.updated_at,
-            message_count=msg_count
+    db_manager = DatabaseManager(db)
+    session = await db_manager.get_session(session_id, with_messages=False)
+    
+    if not session:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="会话不存在"
         )
+    
+    msg_count = await db_manager.count_session_messages(session_id)
+    
+    return SessionResponse(
+        id=session.id,
+        title=session.title,
+        created_at=session.created_at,
+        updated_at=session.updated_at,
+        message_count=msg_count
+    )
 
 
 @app.put("/api/sessions/{session_id}/title")
 async def update_session_title(
     session_id: str,
-    request: UpdateSessionTitle
+    request: UpdateSessionTitle,
+    db: AsyncSession = Depends(get_db)
 ) -> Dict[str, Any]:
     """更新会话标题"""
-    async with AsyncSessionLocal() as db:
-        db_manager = DatabaseManager(db)
-        success = await db_manager.update_session_title(session_id, request.title)
-        
-        if not success:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="会话不存在"
-            )
-        
-        return {"success": True, "message": "标题更新成功"}
+    db_manager = DatabaseManager(db)
+    success = await db_manager.update_session_title(session_id, request.title)
+    
+    if not success:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="会话不存在"
+        )
+    
+    return {"success": True, "message": "标题更新成功"}
 
 
 @app.delete("/api/sessions/{session_id}")
-async def delete_session(session_id: str) -> Dict[str, Any]:
+async def delete_session(
+    session_id: str,
+    db: AsyncSession = Depends(get_db)
+) -> Dict[str, Any]:
     """删除会话"""
-    async with AsyncSessionLocal() as db:
-        db_manager = DatabaseManager(db)
-        success = await db_manager.delete_session(session_id)
-        
-        if not success:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="会话不存在"
-            )
-        
-        # 同时删除该会话的 agent
-        if chat_service:
-            chat_service.remove_agent(session_id)
-        
-        return {"success": True, "message": "会话删除成功"}
+    db_manager = DatabaseManager(db)
+    success = await db_manager.delete_session(session_id)
+    
+    if not success:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="会话不存在"
+        )
+    
+    # 同时删除该会话的 agent
+    if chat_service:
+        chat_service.remove_agent(session_id)
+    
+    return {"success": True, "message": "会话删除成功"}
 
 
 @app.get("/api/sessions/{session_id}/export", response_model=ExportResponse)
 async def export_session(
     session_id: str,
-    format: ExportFormat = ExportFormat.JSON
+    format: ExportFormat = ExportFormat.JSON,
+    db: AsyncSession = Depends(get_db)
 ) -> ExportResponse:
     """导出会话"""
-    async with AsyncSessionLocal() as db:
-        db_manager = DatabaseManager(db)
-        
-        if format == ExportFormat.JSON:
-            content = await db_manager.export_session_json(session_id)
-            filename = f"session_{session_id}.json"
-        else:  # Markdown
-            content = await db_manager.export_session_markdown(session_id)
-            filename = f"session_{session_id}.md"
-        
-        if not content:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="会话不存在"
-            )
-        
-        return ExportResponse(
-            content=content,
-            format=format,
-            filename=filename
+    db_manager = DatabaseManager(db)
+    
+    if format == ExportFormat.JSON:
+        content = await db_manager.export_session_json(session_id)
+        filename = f"session_{session_id}.json"
+    else:  # Markdown
+        content = await db_manager.export_session_markdown(session_id)
+        filename = f"session_{session_id}.md"
+    
+    if not content:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="会话不存在"
         )
+    
+    return ExportResponse(
+        content=content,
+        format=format,
+        filename=filename
+    )
 
 
 # ============= 消息管理 API =============
 
 @app.get("/api/sessions/{session_id}/messages", response_model=List[MessageResponse])
-async def get_session_messages(session_id: str) -> List[MessageResponse]:
+async def get_session_messages(
+    session_id: str,
+    db: AsyncSession = Depends(get_db)
+) -> Response:
     """获取会话的所有消息"""
-    async with AsyncSessionLocal() as db:
-        db_manager = DatabaseManager(db)
-        messages = await db_manager.get_session_messages(session_id, limit=1000)
-        
-        return [
-            MessageResponse(
-                id=msg.id,
-                session_id=msg.session_id,
-                role=msg.role,
-                content=msg.content,
-                timestamp=msg.timestamp
-            )
-            for msg in messages
-        ]
-
-
-@app.post("/api/sessions/{session_id}/chat", response_model=ChatResponse)
+    db_manager = DatabaseManager(db)
+    messages = await db_manager.get_session_messages(session_id, limit=1000)
+    
+    # 直接从 ORM 对象校验并序列化为 JSON 字节，跳过 FastAPI 的二次校验和编码
+    return Response(
+        content=_MESSAGE_LIST_ADAPTER.dump_json(
+            _MESSAGE_LIST_ADAPTER.validate_python(messages, from_attributes=True)
+        ),
+        media_type="application/json"
+    )
+
+
+@app.post("/api/sessions/{session_id}/chat", response_model=ChatResponse, openapi_extra=_CHAT_REQUEST_OPENAPI)
 async def chat_with_session(
     session_id: str,
-    request: ChatRequest
+    request: ChatRequest = Depends(parse_chat_request),
+    db: AsyncSession = Depends(get_db)
 ) -> ChatResponse:
     """发送消息（非流式，带上下文）"""
     if not chat_service or not chat_service.initialized:
@@ -379,98 +536,122 @@ async def chat_with_session(
             detail="聊天服务未初始化"
         )
     
-    async with AsyncSessionLocal() as db:
-        db_manager = DatabaseManager(db)
-        
-        # 1. 验证会话存在
-        session = await db_manager.get_session(session_id)
-        if not session:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="会话不存在"
-            )
+    db_manager = DatabaseManager(db)
+    
+    # 1. 验证会话存在
+    if not await db_manager.session_exists(session_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="会话不存在"
+        )
+    
+    # 2. 获取历史消息（最近 20 条）
+    history = await db_manager.get_session_messages_for_context(session_id, limit=20)
+    
+    # 首条消息：后台生成标题
+    if not history:
+        schedule_title_generation(session_id, request.message)
+    
+    # 3. 调用 AI（带上下文，使用会话专属 agent）
+    try:
+        try:
+            response_content = await chat_service.chat_with_context(session_id, request.message, history)
+        except Exception:
+            # 与流式接口一致：模型调用失败时仍保存用户消息
+            await db_manager.add_message(session_id, "user", request.message)
+            raise
         
-        # 2. 获取历史消息（最近 20 条）
-        history = await db_manager.get_session_messages(session_id, limit=20)
+        # 4. 在同一个事务中保存用户消息和 AI 回复
+        if not await db_manager.add_messages(
+            session_id,
+            [("user", request.message), ("assistant", response_content)]
+        ):
+            logger.warning("会话 {} 已被删除，本轮对话未保存", session_id)
         
-        # 3. 保存用户消息
-        await db_manager.add_message(session_id, "user", request.message)
+        return ChatResponse.build(response_content)
         
-        # 4. 调用 AI（带上下文，使用会话专属 agent）
-        try:
-            response_content = await chat_service.chat_with_context(session_id, request.message, history)
-            
-            # 5. 保存 AI 回复
-            await db_manager.add_message(session_id, "assistant", response_content)
-            
-            return ChatResponse(content=response_content)
-            
-        except Exception as e:
-            logger.error(f"聊天失败: {str(e)}", exc_info=True)
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"聊天失败: {str(e)}"
-            )
+    except Exception as e:
+        logger.error("聊天失败: {}", e, exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"聊天失败: {str(e)}"
+        )
+
+
+async def _save_message(session_id: str, role: str, content: str) -> None:
+    """在独立的数据库会话中保存一条消息"""
+    async with AsyncSessionLocal() as db:
+        await DatabaseManager(db).add_message(session_id, role, content)
 
 
 async def event_generator_with_session(
     session_id: str,
     message: str
-) -> AsyncGenerator[str, None]:
+) -> AsyncGenerator[bytes, None]:
     """带会话的 SSE 事件生成器"""
     if not chat_service or not chat_service.initialized:
         logger.error("聊天服务未初始化")
-        yield f"data: {json.dumps({'error': '聊天服务未初始化'})}\n\n"
+        yield _ERR_NOT_INIT
         return
     
-    accumulated_content = ""
+    content_parts: List[str] = []
+    pending_user_message = False
     
     try:
+        # 整个流程共用一个数据库会话（一次连接获取）
         async with AsyncSessionLocal() as db:
             db_manager = DatabaseManager(db)
             
             # 1. 验证会话存在
-            session = await db_manager.get_session(session_id)
-            if not session:
-                yield f"data: {json.dumps({'error': '会话不存在'})}\n\n"
+            if not await db_manager.session_exists(session_id):
+                yield _ERR_NO_SESSION
                 return
             
             # 2. 获取历史消息
-            history = await db_manager.get_session_messages(session_id, limit=20)
+            history = await db_manager.get_session_messages_for_context(session_id, limit=20)
             
-            # 3. 保存用户消息
-            await db_manager.add_message(session_id, "user", message)
-        
-        # 4. 流式调用 AI（带上下文，使用会话专属 agent）
-        logger.info(f"开始流式聊天（会话: {session_id}）: {message[:50]}...")
-        chunk_count = 0
-        
-        async for chunk in chat_service.stream_chat_with_context(session_id, message, history):
-            accumulated_content += chunk
-            yield f"data: {json.dumps({'content': chunk, 'role': 'assistant'})}\n\n"
-            chunk_count += 1
-            await asyncio.sleep(settings.stream_delay)
-        
-        logger.info(f"流式聊天完成，共发送 {chunk_count} 个数据块")
-        
-        # 5. 保存完整的 AI 回复
-        async with AsyncSessionLocal() as db:
-            db_manager = DatabaseManager(db)
-            await db_manager.add_message(session_id, "assistant", accumulated_content)
+            # 首条消息：后台生成标题
+            if not history:
+                schedule_title_generation(session_id, message)
+            
+            # 3. 用户消息先暂存，与 AI 回复在流结束时一起写入
+            pending_user_message = True
+            
+            # 4. 流式调用 AI（带上下文，使用会话专属 agent）
+            logger.debug("开始流式聊天（会话: {}）: {:.50}...", session_id, message)
+            stream = chat_service.stream_chat_with_context(session_id, message, history)
+            async for frames in _sse_frames(stream, content_parts.append):
+                yield frames
+            
+            logger.debug("流式聊天完成，共发送 {} 个数据块", len(content_parts))
+            
+            # 5. 在同一个事务中保存用户消息和完整的 AI 回复
+            if not await db_manager.add_messages(
+                session_id,
+                [("user", message), ("assistant", "".join(content_parts))]
+            ):
+                logger.warning("会话 {} 已被删除，本轮对话未保存", session_id)
+            pending_user_message = False
         
         # 发送完成标志
-        yield "data: [DONE]\n\n"
+        yield _DONE
         
     except Exception as e:
         error_message = f"流式聊天错误: {str(e)}"
-        logger.error(error_message, exc_info=True)
-        yield f"data: {json.dumps({'error': error_message})}\n\n"
+        logger.error("{}", error_message, exc_info=True)
+        yield _err_frame(error_message)
+    finally:
+        # 流异常结束或客户端断开时，仍在后台保存用户消息
+        if pending_user_message:
+            task = asyncio.create_task(_save_message(session_id, "user", message))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
 
 
-@app.post("/api/sessions/{session_id}/chat/stream")
+@app.post("/api/sessions/{session_id}/chat/stream", openapi_extra=_CHAT_REQUEST_OPENAPI)
 async def stream_chat_with_session(
     session_id: str,
-    request: ChatRequest
+    request: ChatRequest = Depends(parse_chat_request)
 ) -> StreamingResponse:
     """发送消息（流式，带上下文）"""
     if not chat_service or not chat_service.initialized:
@@ -492,7 +673,10 @@ async def stream_chat_with_session(
 
 
 @app.post("/api/sessions/{session_id}/generate-title")
-async def generate_session_title(session_id: str) -> Dict[str, Any]:
+async def generate_session_title(
+    session_id: str,
+    db: AsyncSession = Depends(get_db)
+) -> Dict[str, Any]:
     """基于首条消息生成会话标题"""
     if not chat_service or not chat_service.initialized:
         raise HTTPException(
@@ -500,46 +684,62 @@ async def generate_session_title(session_id: str) -> Dict[str, Any]:
             detail="聊天服务未初始化"
         )
     
-    async with AsyncSessionLocal() as db:
-        db_manager = DatabaseManager(db)
-        
-        # 获取首条用户消息
-        first_message = await db_manager.get_first_user_message(session_id)
-        if not first_message:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="会话中没有用户消息"
-            )
-        
-        # 生成标题
+    db_manager = DatabaseManager(db)
+    
+    # 首条消息发送时已在后台生成标题，等待其完成即可
+    # （后台任务不覆盖自定义标题，这里是显式请求，无条件写入）
+    task = _title_tasks.get(session_id)
+    if task is not None:
         try:
-            title = await chat_service.generate_title(first_message.content)
-            
-            # 更新会话标题
+            title = await asyncio.shield(task)
             await db_manager.update_session_title(session_id, title)
-            
             return {"success": True, "title": title}
-            
         except Exception as e:
-            logger.error(f"标题生成失败: {str(e)}", exc_info=True)
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"标题生成失败: {str(e)}"
-            )
+            logger.warning("后台标题生成失败，重新生成: {}", e)
+    
+    
+    # 获取首条用户消息
+    first_message = await db_manager.get_first_user_message(session_id)
+    if not first_message:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="会话中没有用户消息"
+        )
+    
+    # 生成标题
+    try:
+        title = await chat_service.generate_title(first_message.content)
+        
+        # 更新会话标题
+        await db_manager.update_session_title(session_id, title)
+        
+        return {"success": True, "title": title}
+        
+    except Exception as e:
+        logger.error("标题生成失败: {}", e, exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"标题生成失败: {str(e)}"
+        )
 
 
 if __name__ == "__main__":
     import uvicorn
     
-    logger.info(f"正在启动服务器: http://{settings.host}:{settings.port}")
-    logger.info(f"使用模型: {settings.model_name}")
-    logger.info(f"允许的 CORS 源: {settings.cors_origins_list}")
+    logger.info("正在启动服务器: http://{}:{}", settings.host, settings.port)
+    logger.info("使用模型: {}", settings.model_name)
+    logger.info("允许的 CORS 源: {}", settings.cors_origins_list)
     
+    # loop="auto" 在可用时使用 uvloop（Windows 上回退到 asyncio）
     uvicorn.run(
         "main:app",
         host=settings.host,
         port=settings.port,
-        reload=True,
-        log_level="info"
+        loop="auto",
+        http="httptools",
+        reload=settings.dev,
+        workers=1 if settings.dev else settings.workers,
+        log_level="info" if settings.dev else "warning",
+        access_log=settings.dev
     )
 
@@ -1,23 +1,49 @@
 """
 数据模型定义
 """
+import os
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Optional, Literal, List
+from typing import Annotated, Any, Dict, Optional, Literal, List
 from enum import Enum
-from pydantic import BaseModel, Field
-from autogen_core.models import ModelFamily
+import orjson
+from pydantic import BaseModel, ConfigDict, Field, StringConstraints, TypeAdapter
+
+
+def _openapi_example(example: Dict[str, Any], **config: Any) -> ConfigDict:
+    """构建模型配置，仅在启用 OpenAPI 示例时附带 example
+    
+    示例只用于 /docs 展示，生产环境默认不启用，减少模型构建开销。
+    所有模型统一为不可变（frozen）。
+    
+    Args:
+        example: 示例数据
+        **config: 其他模型配置项
+        
+    Returns:
+        模型配置
+    """
+    config.setdefault("frozen", True)
+    if os.getenv("ENABLE_OPENAPI_EXAMPLES", "").lower() in ("1", "true", "yes", "on"):
+        config["json_schema_extra"] = {"example": example}
+    return ConfigDict(**config)
+
+
+# 用户消息文本：长度约束合并为一个受约束字符串类型
+ChatMessageText = Annotated[str, StringConstraints(min_length=1, max_length=10000)]
 
 
 class ChatRequest(BaseModel):
     """聊天请求模型"""
-    message: str = Field(..., min_length=1, max_length=10000, description="用户消息")
+    message: ChatMessageText = Field(..., description="用户消息")
     
-    class Config:
-        json_schema_extra = {
-            "example": {
-                "message": "你好，请介绍一下你自己"
-            }
-        }
+    model_config = _openapi_example({
+        "message": "你好，请介绍一下你自己"
+    })
+
+
+# 聊天请求校验器：直接校验原始 JSON 请求体，不经过 json.loads 和中间字典
+CHAT_REQUEST_ADAPTER: TypeAdapter[ChatRequest] = TypeAdapter(ChatRequest)
 
 
 class ChatResponse(BaseModel):
@@ -25,20 +51,50 @@ class ChatResponse(BaseModel):
     content: str = Field(..., description="AI 回复内容")
     role: Literal["assistant"] = Field(default="assistant", description="角色")
     
-    class Config:
-        json_schema_extra = {
-            "example": {
-                "content": "你好！我是 AI 助手，很高兴为您服务。",
-                "role": "assistant"
-            }
-        }
+    @classmethod
+    def build(cls, content: str) -> "ChatResponse":
+        """由服务端可信数据构建响应（跳过校验）"""
+        return cls.model_construct(content=content, role="assistant")
+    
+    model_config = _openapi_example({
+        "content": "你好！我是 AI 助手，很高兴为您服务。",
+        "role": "assistant"
+    }, extra="forbid")
 
 
 class StreamChunk(BaseModel):
-    """流式输出数据块"""
+    """流式输出数据块
+    
+    流式接口不实例化该模型，而是通过 stream_chunk_json 按相同结构直接编码。
+    """
     content: str = Field(..., description="内容片段")
     role: Literal["assistant"] = Field(default="assistant", description="角色")
     done: bool = Field(default=False, description="是否完成")
+    
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
+
+# StreamChunk 的 JSON 模板：只有 content 是变化的，其余部分预先编码
+_STREAM_CHUNK_PREFIX = b'{"content":'
+_STREAM_CHUNK_SUFFIX_CONT = b',"role":"assistant","done":false}'
+_STREAM_CHUNK_SUFFIX_DONE = b',"role":"assistant","done":true}'
+
+
+def stream_chunk_json(content: str, done: bool = False) -> bytes:
+    """将流式数据块直接编码为 JSON 字节（与 StreamChunk 序列化结果一致）
+    
+    Args:
+        content: 内容片段
+        done: 是否完成
+        
+    Returns:
+        JSON 字节串
+    """
+    return (
+        _STREAM_CHUNK_PREFIX
+        + orjson.dumps(content)
+        + (_STREAM_CHUNK_SUFFIX_DONE if done else _STREAM_CHUNK_SUFFIX_CONT)
+    )
 
 
 class ErrorResponse(BaseModel):
@@ -46,13 +102,10 @@ class ErrorResponse(BaseModel):
     error: str = Field(..., description="错误信息")
     detail: Optional[str] = Field(None, description="详细错误信息")
     
-    class Config:
-        json_schema_extra = {
-            "example": {
-                "error": "服务器错误",
-                "detail": "无法连接到 OpenAI API"
-            }
-        }
+    model_config = _openapi_example({
+        "error": "服务器错误",
+        "detail": "无法连接到 OpenAI API"
+    }, extra="forbid")
 
 
 class HealthResponse(BaseModel):
@@ -61,30 +114,35 @@ class HealthResponse(BaseModel):
     service: str = Field(default="chat-api", description="服务名称")
     autogen_initialized: bool = Field(..., description="AutoGen 是否已初始化")
     version: str = Field(default="1.0.0", description="API 版本")
-
-
-class ModelInfo(BaseModel):
-    """模型信息配置"""
-    family: ModelFamily = Field(default=ModelFamily.UNKNOWN, description="模型家族")
-    vision: bool = Field(default=False, description="是否支持视觉")
-    function_calling: bool = Field(default=True, description="是否支持函数调用")
-    json_output: bool = Field(default=True, description="是否支持 JSON 输出")
-    structured_output: bool = Field(default=True, description="是否支持结构化输出")
-    multiple_system_messages: bool = Field(default=True, description="是否支持多条系统消息")
-    
-    model_config = {
-        "arbitrary_types_allowed": True,
-        "json_schema_extra": {
-            "example": {
-                "family": "UNKNOWN",
-                "vision": False,
-                "function_calling": True,
-                "json_output": True,
-                "structured_output": True,
-                "multiple_system_messages": True
-            }
-        }
-    }
+    
+    model_config = ConfigDict(frozen=True, extra="forbid")
+    
+    @classmethod
+    def build(cls, healthy: bool) -> "HealthResponse":
+        """由服务端可信数据构建健康检查响应（跳过校验）"""
+        return cls.model_construct(
+            status="healthy" if healthy else "unhealthy",
+            service="chat-api",
+            autogen_initialized=healthy,
+            version="1.0.0"
+        )
+
+
+def _unknown_model_family() -> str:
+    """默认模型家族（延迟导入 autogen_core，只导入请求/响应模型的进程无需加载它）"""
+    from autogen_core.models import ModelFamily
+    return ModelFamily.UNKNOWN
+
+
+@dataclass(slots=True, frozen=True)
+class ModelInfo:
+    """模型信息配置（内部静态配置，不校验外部输入）"""
+    family: str = field(default_factory=_unknown_model_family)  # 模型家族
+    vision: bool = False  # 是否支持视觉
+    function_calling: bool = True  # 是否支持函数调用
+    json_output: bool = True  # 是否支持 JSON 输出
+    structured_output: bool = True  # 是否支持结构化输出
+    multiple_system_messages: bool = True  # 是否支持多条系统消息
 
 
 # ============= 会话管理相关模型 =============
@@ -99,13 +157,9 @@ class SessionCreate(BaseModel):
     """创建会话请求"""
     title: Optional[str] = Field(default="新对话", description="会话标题")
     
-    model_config = {
-        "json_schema_extra": {
-            "example": {
-                "title": "讨论 Python 编程"
-            }
-        }
-    }
+    model_config = _openapi_example({
+        "title": "讨论 Python 编程"
+    })
 
 
 class SessionResponse(BaseModel):
@@ -116,23 +170,21 @@ class SessionResponse(BaseModel):
     updated_at: datetime = Field(..., description="更新时间")
     message_count: Optional[int] = Field(default=0, description="消息数量")
     
-    model_config = {
-        "json_schema_extra": {
-            "example": {
-                "id": "550e8400-e29b-41d4-a716-446655440000",
-                "title": "讨论 Python 编程",
-                "created_at": "2024-01-01T12:00:00",
-                "updated_at": "2024-01-01T12:30:00",
-                "message_count": 10
-            }
-        }
-    }
+    model_config = _openapi_example({
+        "id": "550e8400-e29b-41d4-a716-446655440000",
+        "title": "讨论 Python 编程",
+        "created_at": "2024-01-01T12:00:00",
+        "updated_at": "2024-01-01T12:30:00",
+        "message_count": 10
+    })
 
 
 class SessionList(BaseModel):
     """会话列表响应"""
     sessions: List[SessionResponse] = Field(..., description="会话列表")
     total: int = Field(..., description="总数")
+    
+    model_config = ConfigDict(frozen=True)
 
 
 class MessageResponse(BaseModel):
@@ -143,50 +195,40 @@ class MessageResponse(BaseModel):
     content: str = Field(..., description="消息内容")
     timestamp: datetime = Field(..., description="时间戳")
     
-    model_config = {
-        "json_schema_extra": {
-            "example": {
-                "id": "msg-001",
-                "session_id": "session-001",
-                "role": "user",
-                "content": "你好",
-                "timestamp": "2024-01-01T12:00:00"
-            }
-        }
-    }
+    model_config = _openapi_example({
+        "id": "msg-001",
+        "session_id": "session-001",
+        "role": "user",
+        "content": "你好",
+        "timestamp": "2024-01-01T12:00:00"
+    })
 
 
 class ChatRequestWithSession(BaseModel):
     """带会话 ID 的聊天请求"""
-    message: str = Field(..., min_length=1, max_length=10000, description="用户消息")
+    message: ChatMessageText = Field(..., description="用户消息")
     session_id: str = Field(..., description="会话 ID")
     
-    model_config = {
-        "json_schema_extra": {
-            "example": {
-                "message": "什么是人工智能？",
-                "session_id": "550e8400-e29b-41d4-a716-446655440000"
-            }
-        }
-    }
+    model_config = _openapi_example({
+        "message": "什么是人工智能？",
+        "session_id": "550e8400-e29b-41d4-a716-446655440000"
+    })
 
 
 class UpdateSessionTitle(BaseModel):
     """更新会话标题请求"""
     title: str = Field(..., min_length=1, max_length=200, description="新标题")
     
-    model_config = {
-        "json_schema_extra": {
-            "example": {
-                "title": "AI 基础知识讨论"
-            }
-        }
-    }
+    model_config = _openapi_example({
+        "title": "AI 基础知识讨论"
+    })
 
 
 class ExportRequest(BaseModel):
     """导出请求"""
     format: ExportFormat = Field(default=ExportFormat.JSON, description="导出格式")
+    
+    model_config = ConfigDict(frozen=True)
 
 
 class ExportResponse(BaseModel):
@@ -194,4 +236,6 @@ class ExportResponse(BaseModel):
     content: str = Field(..., description="导出的内容")
     format: ExportFormat = Field(..., description="导出格式")
     filename: str = Field(..., description="建议的文件名")
+    
+    model_config = ConfigDict(frozen=True)
 
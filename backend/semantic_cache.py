@@ -0,0 +1,160 @@
+"""
+语义缓存模块
+对相同的用户消息复用已生成的回复，避免重复调用大模型
+"""
+import hashlib
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from logger import logger
+
+
+def normalize(text: str) -> str:
+    """规范化消息文本：转小写并合并连续空白
+
+    只做不改变语义的规范化。字符 n-gram 相似度无法区分“偶数/奇数”、
+    “France/Spain”这类只差几个字的不同问题，因此在接入真正的嵌入模型之前，
+    缓存只在规范化后的消息完全相同时命中。
+
+    Args:
+        text: 输入文本
+
+    Returns:
+        规范化后的文本
+    """
+    return " ".join(text.lower().split())
+
+
+# 常见的礼貌前缀与句尾标点，用于生成本地改写
+# 不包含单独的“请”：它常是词的一部分（如“请假”“请客”），去掉会改变语义
+_POLITE_PREFIXES = ("请问", "请帮我", "你好，", "你好,", "您好，", "您好,")
+_TRAILING_PUNCTUATION = "？?。.!！~～ "
+
+
+def paraphrases(text: str, limit: int) -> List[str]:
+    """基于模板生成消息的等价改写
+
+    通过增删礼貌前缀、句尾标点生成与原消息意思相同的若干变体，
+    用于预填充语义缓存，无需调用模型。
+
+    Args:
+        text: 原始消息
+        limit: 最多返回的变体数量
+
+    Returns:
+        不包含原消息本身的变体列表
+    """
+    core = text.strip()
+    for prefix in _POLITE_PREFIXES:
+        if core.startswith(prefix):
+            core = core[len(prefix):].lstrip()
+            break
+    core = core.rstrip(_TRAILING_PUNCTUATION)
+    if not core:
+        return []
+
+    candidates = [core, core + "？", core + "?", "请问" + core + "？", core + "。"]
+    variants: List[str] = []
+    for candidate in candidates:
+        if candidate != text and candidate not in variants:
+            variants.append(candidate)
+        if len(variants) >= limit:
+            break
+    return variants
+
+
+class SemanticCache:
+    """语义缓存
+
+    按命名空间（如系统提示词的哈希）隔离缓存条目，
+    以规范化后的消息为键，查询为一次字典查找。
+    消息的等价改写作为条目的别名保存，不单独占用缓存容量，随条目一起淘汰。
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        """初始化语义缓存
+
+        Args:
+            max_entries: 每个命名空间最多保存的条目数（超出时淘汰最旧的）
+        """
+        self.max_entries: int = max_entries
+        # 命名空间 -> {键: (回复, 别名键列表)}
+        self._entries: Dict[str, "OrderedDict[str, Tuple[str, List[str]]]"] = {}
+        # 命名空间 -> {别名键: 条目键}
+        self._aliases: Dict[str, Dict[str, str]] = {}
+
+    @staticmethod
+    def namespace_for(system_message: str) -> str:
+        """根据系统提示词生成命名空间"""
+        return hashlib.blake2b(system_message.encode("utf-8"), digest_size=16).hexdigest()
+
+    def lookup(self, namespace: str, query: str) -> Optional[str]:
+        """查找与查询相同（规范化后）的缓存回复
+
+        Args:
+            namespace: 命名空间
+            query: 用户消息
+
+        Returns:
+            命中时返回缓存的回复，否则返回 None
+        """
+        entries = self._entries.get(namespace)
+        if not entries:
+            return None
+
+        key = normalize(query)
+        if key not in entries:
+            key = self._aliases.get(namespace, {}).get(key)
+            if key is None:
+                return None
+
+        logger.debug("语义缓存命中")
+        entries.move_to_end(key)
+        return entries[key][0]
+
+    def store(self, namespace: str, query: str, response: str) -> None:
+        """写入缓存
+
+        Args:
+            namespace: 命名空间
+            query: 用户消息
+            response: 模型回复
+        """
+        entries = self._entries.setdefault(namespace, OrderedDict())
+        key = normalize(query)
+        existing = entries.get(key)
+        entries[key] = (response, existing[1] if existing else [])
+        entries.move_to_end(key)
+        if len(entries) > self.max_entries:
+            _, (_, alias_keys) = entries.popitem(last=False)
+            aliases = self._aliases.get(namespace, {})
+            for alias_key in alias_keys:
+                aliases.pop(alias_key, None)
+
+    def add_aliases(self, namespace: str, query: str, variants: Iterable[str]) -> None:
+        """为已缓存的消息添加等价改写，命中改写时返回原消息的回复
+
+        Args:
+            namespace: 命名空间
+            query: 已缓存的用户消息
+            variants: 等价改写列表
+        """
+        key = normalize(query)
+        entry = self._entries.get(namespace, {}).get(key)
+        if entry is None:
+            return
+
+        aliases = self._aliases.setdefault(namespace, {})
+        for variant in variants:
+            alias_key = normalize(variant)
+            if alias_key != key and alias_key not in aliases:
+                aliases[alias_key] = key
+                entry[1].append(alias_key)
+
+    def clear(self) -> None:
+        """清空缓存"""
+        self._entries.clear()
+        self._aliases.clear()
+
+
+__all__ = ["SemanticCache", "normalize", "paraphrases"]
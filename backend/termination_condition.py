@@ -1,4 +1,5 @@
-from typing import Sequence
+import sys
+from typing import Callable, Sequence
 
 from autogen_agentchat.base import TerminatedException, TerminationCondition
 from autogen_agentchat.messages import BaseAgentEvent, BaseChatMessage, StopMessage
@@ -7,10 +8,14 @@ from pydantic import BaseModel
 from typing_extensions import Self
 
 
+# 终止消息的来源，所有实例共享同一个驻留字符串
+_STOP_SOURCE = sys.intern("SourcePrefixTermination")
+
+
 # 1. 定义配置类 (用于序列化)
 class SourcePrefixTerminationConfig(BaseModel):
     """Configuration for the prefix match termination condition."""
-    prefix: str
+    prefix: str | tuple[str, ...]
 
 
 # 2. 定义主逻辑类
@@ -22,29 +27,62 @@ class SourcePrefixTermination(TerminationCondition, Component[SourcePrefixTermin
     # 如果你是作为库发布，这里写完整的包路径；如果是本地运行，保持默认或自定义字符串
     component_provider_override = "backend.termination_condition.SourcePrefixTermination"
 
-    def __init__(self, prefix: str) -> None:
+    # 实例属性使用槽位存储（基类没有定义 __slots__，实例仍保留 __dict__）
+    __slots__ = ("_terminated", "_prefix", "_prefix_tuple", "_stop_suffix", "_match")
+
+    def __init__(self, prefix: str | tuple[str, ...]) -> None:
         self._terminated = False
         self._prefix = prefix
+        # str.startswith 接受元组，一次调用即可匹配所有前缀
+        self._prefix_tuple: tuple[str, ...] = (prefix,) if isinstance(prefix, str) else tuple(prefix)
+        # 空前缀会匹配任何 source，导致第一条消息就终止对话
+        if not self._prefix_tuple or "" in self._prefix_tuple:
+            raise ValueError("prefix must be a non-empty string or a tuple of non-empty strings")
+
+        # 终止消息中除 source 以外的部分在构造时确定
+        self._stop_suffix = f"' starts with '{prefix}'."
+
+        # 单个短前缀（常见的 agent 名称）用切片比较，其余情况用 startswith
+        self._match: Callable[[str], bool]
+        if len(self._prefix_tuple) == 1 and len(self._prefix_tuple[0]) <= 4:
+            single = self._prefix_tuple[0]
+            n = len(single)
+            self._match = lambda s: s[:n] == single
+        else:
+            prefixes = self._prefix_tuple
+            self._match = lambda s: s.startswith(prefixes)
 
     @property
     def terminated(self) -> bool:
         return self._terminated
 
     async def __call__(self, messages: Sequence[BaseAgentEvent | BaseChatMessage]) -> StopMessage | None:
+        return self._check_sync(messages)
+
+    def _check_sync(self, messages: Sequence[BaseAgentEvent | BaseChatMessage]) -> StopMessage | None:
+        """同步执行终止检查（不需要等待任何操作，已知是同步检查的调用方可直接调用）"""
         # 如果已经终止，防止重复调用
         if self._terminated:
             raise TerminatedException("Termination condition has already been reached")
 
-        # 遍历当前批次的消息
-        for message in messages:
-            # 检查消息是否有 source 属性，并且是否以指定前缀开头
-            if hasattr(message, "source") and message.source.startswith(self._prefix):
-                self._terminated = True
-                return StopMessage(
-                    content=f"Terminated because source '{message.source}' starts with '{self._prefix}'.",
-                    source="SourcePrefixTermination",
-                )
-        return None
+        match: Callable[[str], bool] = self._match
+        # 查找第一条 source 以指定前缀开头的消息（没有 source 属性的消息跳过）
+        source: str | None = next(
+            (
+                s for m in messages
+                if (s := getattr(m, "source", None)) is not None and match(s)
+            ),
+            None,
+        )
+        if source is None:
+            return None
+
+        self._terminated = True
+        # 内容由可信数据构建，跳过校验
+        return StopMessage.model_construct(
+            content="Terminated because source '" + source + self._stop_suffix,
+            source=_STOP_SOURCE,
+        )
 
     async def reset(self) -> None:
         self._terminated = False